@@ -0,0 +1,383 @@
+import collections
+import concurrent.futures
+import heapq
+import time
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+from geometry import nearestPoints
+from metrics import metrics
+from utils import distbetween
+from world import dijkstraToTargetsInWorker
+
+INF = float("inf")
+
+# Time-budgeted path planning. A cold World.estimatePath (Dijkstra over the whole DEM graph) blocks the tick
+# which needs the path, f.e. a low-battery diversion. AnytimePlanner.plan() returns within the budget:
+#  - the cached exact path if there is one,
+#  - otherwise the path of the last weighted A* search finished before the deadline, searches run with decreasing
+#    weights (WEIGHTS), a path of weight w costs at most w times the shortest one and weight 1 gives an exact path,
+#  - if not even the first search finished - path to the expanded vertex closest to the goal and then over a coarse roadmap
+#    (a node per ROADMAP_PIXELS x ROADMAP_PIXELS block, edges to neighbor blocks only if the straight segment crosses no
+#    prohibited pixels), so the route stays off prohibited pixels; if the roadmap can't connect them,
+#    an exact search is done over the budget (see "roadmap_failures").
+# Not exact paths are refined in the background (exact Dijkstra in processes of World.pathPlanningPool, the result is cached
+# for World.estimatePath too) and swapped into drone's pathPlannerMission, unless the drone got another route since then.
+# Without worker processes refinements are exact A* searches resumed by every tick() for at most one budget in total.
+# Latency of every plan() call goes to "path_planning_latency" histogram of metrics, see stats() for exact p50/p99.
+
+WEIGHTS = (4.0, 2.0, 1.0)
+SEARCH_SHARE = 0.8
+ROADMAP_PIXELS = 3
+
+
+def pathTo(parents, vertex):
+    vertices = [vertex]
+    while parents[vertices[-1]] is not None:
+        vertices.append(parents[vertices[-1]])
+    return vertices[::-1]
+
+
+class Search:
+
+    # weighted A* which stops at a deadline and can be resumed later
+    def __init__(self, adj, source, target, heuristic, weight):
+        self.adj = adj
+        self.target = target
+        self.heuristic = heuristic
+        self.weight = weight
+        self.g = {source: 0.0}
+        self.parents = {source: None}
+        self.closed = set()
+        self.heap = [(weight * heuristic(source, target), source)]
+        self.best, self.best_h = source, heuristic(source, target)
+        self.expansions = 0
+
+    def partial(self):
+        # vertices to the expanded vertex closest to target
+        return pathTo(self.parents, self.best)
+
+    def run(self, deadline):
+        # returns vertices or None if deadline passed
+        while self.heap:
+            _, u = heapq.heappop(self.heap)
+            if u in self.closed:
+                continue
+            if u == self.target:
+                return pathTo(self.parents, u)
+            self.closed.add(u)
+            self.expansions += 1
+            h = self.heuristic(u, self.target)
+            if h < self.best_h:
+                self.best, self.best_h = u, h
+            for v, data in self.adj[u].items():
+                cost = self.g[u] + data['weight']
+                if v not in self.closed and cost < self.g.get(v, INF):
+                    self.g[v] = cost
+                    self.parents[v] = u
+                    heapq.heappush(self.heap, (cost + self.weight * self.heuristic(v, self.target), v))
+            if time.perf_counter() > deadline:
+                return None
+        raise nx.NetworkXNoPath("no path between {} and {}".format(pathTo(self.parents, self.best)[0], self.target))
+
+
+def weightedAStar(adj, source, target, heuristic, weight, deadline):
+    # returns (vertices or None if deadline passed, vertices to the expanded vertex closest to target, expansions)
+    search = Search(adj, source, target, heuristic, weight)
+    vertices = search.run(deadline)
+    return vertices, search.partial() if vertices is None else None, search.expansions
+
+
+class AnytimePlanner:
+
+    def __init__(self, world, budget, workers=1, latencies_kept=10000):
+        self.world = world
+        self.budget = budget  # seconds per plan() call
+        self.workers = workers  # 0 - refinements are done in the main thread by the next tick()
+        # processes and not threads: a pure python search in a thread would hold GIL and delay plan() calls
+        self.executor = world.pathPlanningPool(workers) if workers > 0 else None
+        # [(drone, route to swap or None, start, finish, (start vertex, finish vertex), Future or Search without workers), ...]
+        self.pending = []
+        self.roadmap_mask = None  # prohibited mask the roadmap was built for
+        self.roadmap_nodes = None  # (x, y) of a node per block, nan for blocks without allowed pixels
+        self.roadmap_graph = None
+        self.roadmap_components = None  # connected component of every node
+        self.roadmap_trees = {}  # target node -> predecessors of shortest paths to it, targets are mostly stations and missions
+        self.fallback_seconds = 0.0  # moving average of fallback path building time
+        self.latencies = collections.deque(maxlen=latencies_kept)
+
+        self.calls = 0
+        self.cache_hits = 0
+        self.exact = 0
+        self.weighted = 0
+        self.fallbacks = 0
+        self.roadmap_failures = 0
+        self.expansions = 0
+        self.deadline_misses = 0
+        self.refinements = 0
+        self.swaps = 0
+        self.stale = 0
+        self.failures = 0
+        self.roadmap()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        return {"budget_ms": self.budget * 1000.0, "calls": self.calls, "cache_hits": self.cache_hits, "exact": self.exact,
+                "weighted": self.weighted, "fallbacks": self.fallbacks, "roadmap_failures": self.roadmap_failures,
+                "expansions": self.expansions, "deadline_misses": self.deadline_misses, "p50_ms": float(np.percentile(latencies, 50)) * 1000.0,
+                "p99_ms": float(np.percentile(latencies, 99)) * 1000.0, "max_ms": float(latencies.max()) * 1000.0,
+                "pending": len(self.pending), "refinements": self.refinements, "swaps": self.swaps,
+                "stale": self.stale, "failures": self.failures}
+
+    def pixelPath(self, start, finish, vertices):
+        # pixels centers without the middle ones of straight runs, linear in path length unlike simplifyPath
+        xys = [start]
+        for previous, vertexId, following in zip(vertices, vertices[1:], vertices[2:]):
+            if vertexId - previous != following - vertexId:
+                i, j = self.world.fromVertexId(vertexId)
+                xys.append(((i + 0.5) * self.world.dem_resolution, (j + 0.5) * self.world.dem_resolution))
+        xys.append(finish)
+        return xys
+
+    def roadmap(self):
+        # rebuilt when no-fly zones change the prohibited mask
+        mask = self.world.dem_prohibited_mask
+        if self.roadmap_mask is mask:
+            return self.roadmap_nodes, self.roadmap_graph
+        c, resolution = ROADMAP_PIXELS, self.world.dem_resolution
+        height, width = -(-mask.shape[0] // c), -(-mask.shape[1] // c)
+        padded = np.ones((height * c, width * c), bool)
+        padded[:mask.shape[0], :mask.shape[1]] = mask
+        # node of a block - its allowed pixel closest to the block center
+        js, is_ = np.mgrid[0:height * c, 0:width * c]
+        offsets = np.where(padded, INF, np.hypot(js % c - (c - 1) / 2.0, is_ % c - (c - 1) / 2.0))
+
+        def blocks(a):
+            return a.reshape(height, c, width, c).transpose(0, 2, 1, 3).reshape(height, width, c * c)
+        best = blocks(offsets).argmin(axis=2)[:, :, None]
+        has_node = np.isfinite(np.take_along_axis(blocks(offsets), best, axis=2)[:, :, 0])
+        nodes = np.stack([(np.take_along_axis(blocks(is_), best, axis=2)[:, :, 0] + 0.5) * resolution,
+                          (np.take_along_axis(blocks(js), best, axis=2)[:, :, 0] + 0.5) * resolution], axis=2)
+        nodes[~has_node] = np.nan
+        nodes = nodes.reshape(-1, 2)
+        # edges between nodes of neighbor blocks, if the straight segment between them crosses no prohibited pixels
+        bj, bi = np.mgrid[0:height, 0:width]
+        rows, cols = [], []
+        for dj, di in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            j0, i0 = bj[:height - dj, max(0, -di):width - max(0, di)].ravel(), bi[:height - dj, max(0, -di):width - max(0, di)].ravel()
+            u, v = j0 * width + i0, (j0 + dj) * width + i0 + di
+            ok = has_node.ravel()[u] & has_node.ravel()[v]
+            u, v = u[ok], v[ok]
+            ok = ~self.segmentsBlocked(nodes[u, 0], nodes[u, 1], nodes[v, 0], nodes[v, 1])
+            rows.append(u[ok])
+            cols.append(v[ok])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        weights = np.hypot(nodes[rows, 0] - nodes[cols, 0], nodes[rows, 1] - nodes[cols, 1])
+        # both directions, so that dijkstra() doesn't symmetrize the graph on every call
+        graph = coo_matrix((np.concatenate([weights, weights]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                           shape=(len(nodes), len(nodes))).tocsr()
+        self.roadmap_mask, self.roadmap_nodes, self.roadmap_graph = mask, nodes, graph
+        _, self.roadmap_components = connected_components(graph, directed=False)
+        self.roadmap_trees = {}
+        return nodes, graph
+
+    def segmentsBlocked(self, x0, y0, x1, y1):
+        # as World.isRouteBlocked, for many segments at once; samples are checked with a small margin around them,
+        # so that a segment grazing a corner of a prohibited pixel is blocked whichever way it is sampled
+        mask, resolution = self.world.dem_prohibited_mask, self.world.dem_resolution
+        x0, y0, x1, y1 = np.broadcast_arrays(*[np.asarray(a, np.float64) for a in (x0, y0, x1, y1)])
+        if x0.size == 0:
+            return np.zeros(x0.shape, bool)
+        n = max(1, int(np.ceil(np.hypot(x1 - x0, y1 - y0).max() / (resolution / 4.0))))
+        ts = np.linspace(0.0, 1.0, n + 1)
+        xs, ys = x0[..., None] + (x1 - x0)[..., None] * ts, y0[..., None] + (y1 - y0)[..., None] * ts
+        blocked = np.zeros(xs.shape[:-1], bool)
+        margin = resolution / 100.0
+        for dx in (-margin, margin):
+            for dy in (-margin, margin):
+                i = np.clip(((xs + dx) // resolution).astype(np.int64), 0, mask.shape[1] - 1)
+                j = np.clip(((ys + dy) // resolution).astype(np.int64), 0, mask.shape[0] - 1)
+                blocked |= mask[j, i].any(axis=-1)
+        return blocked
+
+    def roadmapEntries(self, x, y, nodes, radius=2):
+        # roadmap nodes of nearby blocks reachable from (x, y) by a straight segment, the closest first
+        width = -(-self.world.dem_prohibited_mask.shape[1] // ROADMAP_PIXELS)
+        height = len(nodes) // width
+        size = ROADMAP_PIXELS * self.world.dem_resolution
+        i0, j0 = int(x // size), int(y // size)
+        bj, bi = np.mgrid[max(0, j0 - radius):min(height, j0 + radius + 1), max(0, i0 - radius):min(width, i0 + radius + 1)]
+        candidates = (bj * width + bi).ravel()
+        candidates = candidates[~np.isnan(nodes[candidates, 0])]
+        candidates = candidates[~self.segmentsBlocked(x, y, nodes[candidates, 0], nodes[candidates, 1])]
+        return candidates[np.argsort(np.hypot(nodes[candidates, 0] - x, nodes[candidates, 1] - y), kind="stable")]
+
+    def roadmapPath(self, x0, y0, x1, y1):
+        # roadmap nodes between (x0, y0) and (x1, y1) or None
+        nodes, graph = self.roadmap()
+        targets = self.roadmapEntries(x1, y1, nodes)
+        # entries in the same connected component of the roadmap
+        sources = [int(node) for node in self.roadmapEntries(x0, y0, nodes)
+                   if self.roadmap_components[node] in self.roadmap_components[targets]]
+        if len(sources) == 0:
+            return None
+        source = sources[0]
+        target = int(targets[self.roadmap_components[targets] == self.roadmap_components[source]][0])
+        if target not in self.roadmap_trees:
+            _, self.roadmap_trees[target] = dijkstra(graph, indices=target, return_predecessors=True)
+        predecessors = self.roadmap_trees[target]
+        path = [source]
+        while path[-1] != target:
+            path.append(int(predecessors[path[-1]]))
+        return [(float(nodes[node, 0]), float(nodes[node, 1])) for node in path]
+
+    def plan(self, x0, y0, x1, y1):
+        # returns (path, is exact, vertices of exact path if it still has to be cached)
+        started = time.perf_counter()
+        # searches stop a bit earlier, the rest of the budget is left for the path building,
+        # the first one - also for the fallback path, if it doesn't finish
+        deadline = started + self.budget * SEARCH_SHARE
+        first_deadline = deadline - min(self.fallback_seconds, self.budget * SEARCH_SHARE / 2)
+        world = self.world
+        start, finish = (x0, y0), (x1, y1)
+        startId, finishId = world.navigableVertexId(x0, y0), world.navigableVertexId(x1, y1)
+        self.calls += 1
+
+        key = (startId, finishId)
+        if key in world.cachedPaths:
+            self.cache_hits += 1
+            xys, exact, vertices = world.cachedPath(key, start, finish), True, None
+        else:
+            vertices, partial, exact = None, None, False
+            for weight in WEIGHTS:
+                found, partial, expansions = weightedAStar(world.g.adj, startId, finishId, world.vertexDistance, weight,
+                                                           first_deadline if weight == WEIGHTS[0] else deadline)
+                self.expansions += expansions
+                if found is None:
+                    break
+                vertices, exact = found, weight == 1.0
+                if time.perf_counter() > deadline:
+                    break
+            if vertices is not None:
+                xys = self.pixelPath(start, finish, vertices)
+                if exact:
+                    self.exact += 1
+                else:
+                    self.weighted += 1
+                    vertices = None
+            else:
+                self.fallbacks += 1
+                fallback_started = time.perf_counter()
+                xys = self.fallbackPath(start, finish, partial)
+                self.fallback_seconds += 0.2 * (time.perf_counter() - fallback_started - self.fallback_seconds)
+                if xys is None:
+                    self.roadmap_failures += 1
+                    vertices = Search(world.g.adj, startId, finishId, world.vertexDistance, 1.0).run(INF)
+                    xys, exact = self.pixelPath(start, finish, vertices), True
+
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        metrics.observe("path_planning_latency", latency)
+        if latency > self.budget:
+            self.deadline_misses += 1
+        return xys, exact, vertices
+
+    def fallbackPath(self, start, finish, partial):
+        # to the expanded vertex closest to finish and then over the roadmap, if the roadmap can't be entered from there
+        # (f.e. the vertex is in a pocket which the graph leaves by jumps over prohibited pixels) - from earlier vertices
+        n = len(partial)
+        for k in sorted({n - 1, 3 * (n - 1) // 4, (n - 1) // 2, (n - 1) // 4, 0}, reverse=True):
+            if k > 0:
+                i, j = self.world.fromVertexId(partial[k])
+                end = ((i + 0.5) * self.world.dem_resolution, (j + 0.5) * self.world.dem_resolution)
+                xys = self.pixelPath(start, end, partial[:k + 1])
+            else:
+                xys = [start]
+            nodes = self.roadmapPath(*xys[-1], *finish)
+            if nodes is not None:
+                return xys + nodes + [finish]
+        return None
+
+    def planRoute(self, drone, x, y):
+        # sets drone's route to (x, y), not exact route is refined later
+        start, finish = (drone.x, drone.y), (x, y)
+        # ShardedScheduler may plan routes from several threads
+        with self.world.paths_lock:
+            xys, exact, vertices = self.plan(*start, *finish)
+            drone.setRoute(xys)
+            ids = (self.world.navigableVertexId(*start), self.world.navigableVertexId(*finish))
+            if vertices is not None:
+                # exact path is cached by tick(), out of the time budget
+                future = concurrent.futures.Future()
+                future.set_result(({ids[1]: vertices}, 0))
+                self.pending.append((drone, None, start, finish, ids, future))
+            elif not exact:
+                if self.executor is not None:
+                    future = self.executor.submit(dijkstraToTargetsInWorker, ids[0], [ids[1]])
+                else:
+                    future = Search(self.world.g.adj, ids[0], ids[1], self.world.vertexDistance, 1.0)
+                self.pending.append((drone, drone.pathPlannerMission, start, finish, ids, future))
+
+    def prohibitedMaskChanged(self):
+        # called by World.updateProhibitedMask, so that the roadmap is not rebuilt within a plan() budget
+        self.roadmap()
+
+    def tick(self):
+        # searches without workers are resumed until one budget is spent, the rest of them continue on the next tick
+        deadline = time.perf_counter() + self.budget
+        pending = []
+        for job in self.pending:
+            drone, route, start, finish, ids, future = job
+            if isinstance(future, Search):
+                if time.perf_counter() > deadline:
+                    pending.append(job)
+                    continue
+                try:
+                    vertices = future.run(deadline)
+                except nx.NetworkXNoPath:
+                    self.failures += 1
+                    continue
+                if vertices is None:
+                    pending.append(job)
+                    continue
+            elif not future.done():
+                pending.append(job)
+                continue
+            else:
+                paths, _ = future.result()
+                vertices = paths.get(ids[1])
+            # worker processes have the graph without no-fly zones added after the start
+            if vertices is None or not all(self.world.g.has_edge(u, v) for u, v in zip(vertices, vertices[1:])):
+                # the drone keeps its route, routes crossing no-fly zones are repaired by World.repairRoutes
+                self.failures += 1
+                continue
+            # pixel centers and not World.pathFromVertices: simplifyPath of a long path alone takes more than a budget
+            xys = self.pixelPath(start, finish, vertices)
+            self.world.cachePath(ids, xys, vertices)
+            if route is not None:
+                self.refinements += 1
+                self.swap(drone, route, xys)
+        self.pending = pending
+
+    def swap(self, drone, route, xys):
+        if drone.pathPlannerMission is not route or route.finished():
+            self.stale += 1
+            return
+        # continue from the current position with the closest waypoint of the exact path, unless it is already behind
+        order, _ = nearestPoints(drone.x, drone.y, [xy[0] for xy in xys], [xy[1] for xy in xys], 1)
+        k = int(order[0])
+        if k + 1 < len(xys) and distbetween(drone.x, drone.y, *xys[k + 1]) < distbetween(*xys[k], *xys[k + 1]):
+            k += 1
+        path = [(drone.x, drone.y)] + [xy for xy in xys[k:] if xy != (drone.x, drone.y)]
+        if len(path) < 2:
+            self.stale += 1
+            return
+        drone.setRoute(path)
+        self.swaps += 1
@@ -0,0 +1 @@
+# Benchmarks of the simulator hot paths on synthetic scenarios, see benchmarks/run.py
@@ -0,0 +1,92 @@
+import argparse
+import json
+import statistics
+
+import numpy as np
+
+from benchmarks.run import measure
+from geometry import distancesTo, distancesPointToSegments, segmentsIntersect, nearestPoints
+from utils import distbetween, isIntersects
+
+
+# Scalar helpers from utils vs batch kernels from geometry.py on growing number of elements,
+# reports the smallest size from which kernels are faster (including conversion of python lists to arrays).
+# Usage (from the repository root):
+#   python -m benchmarks.geometry --output geometry.json
+
+SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 4096]
+
+
+def scalarPointToSegments(px, py, ax, ay, bx, by):
+    # the same as utils.distancePointToSegment before float64 kernels, but without numpy per call
+    distances = []
+    for x0, y0, x1, y1 in zip(ax, ay, bx, by):
+        dx, dy = x1 - x0, y1 - y0
+        length2 = dx * dx + dy * dy
+        t = min(1.0, max(0.0, ((px - x0) * dx + (py - y0) * dy) / length2)) if length2 > 0 else 0.0
+        distances.append(distbetween(px, py, x0 + t * dx, y0 + t * dy))
+    return distances
+
+
+def cases(rng, n):
+    xs, ys = list(rng.uniform(0, 22500, n)), list(rng.uniform(0, 22500, n))
+    xs1, ys1 = [x + rng.uniform(-500, 500) for x in xs], [y + rng.uniform(-500, 500) for y in ys]
+    x, y, x1, y1 = 11000.0, 11000.0, 11300.0, 10800.0
+    return {
+        "distances_to_points": (
+            lambda: [distbetween(x, y, xi, yi) for xi, yi in zip(xs, ys)],
+            lambda: distancesTo(x, y, xs, ys)),
+        "distances_point_to_segments": (
+            lambda: scalarPointToSegments(x, y, xs, ys, xs1, ys1),
+            lambda: distancesPointToSegments(x, y, xs, ys, xs1, ys1)),
+        "segments_intersect": (
+            lambda: [isIntersects(x, y, x1, y1, xi, yi, xj, yj) for xi, yi, xj, yj in zip(xs, ys, xs1, ys1)],
+            lambda: segmentsIntersect(x, y, x1, y1, np.array(xs), np.array(ys), np.array(xs1), np.array(ys1))),
+        "nearest_4_points": (
+            lambda: sorted(range(n), key=lambda i: (distbetween(x, y, xs[i], ys[i]), i))[:4],
+            lambda: nearestPoints(x, y, xs, ys, 4)),
+    }
+
+
+def runGeometryBenchmarks(repeats, seed=239):
+    rng = np.random.default_rng(seed)
+    results = {}
+    for n in SIZES:
+        for name, (scalar, kernel) in cases(rng, n).items():
+            # each measurement is a batch of calls, so that timer resolution doesn't matter for small sizes
+            calls = max(1, 4096 // n)
+            scalar_time = statistics.median(measure(lambda _: [scalar() for _ in range(calls)], repeats)) / calls
+            kernel_time = statistics.median(measure(lambda _: [kernel() for _ in range(calls)], repeats)) / calls
+            results.setdefault(name, []).append({"n": n, "scalar": scalar_time, "kernel": kernel_time})
+    return results
+
+
+def crossover(measurements):
+    # the smallest size from which kernel is faster for all larger sizes
+    size = None
+    for measurement in reversed(measurements):
+        if measurement["kernel"] >= measurement["scalar"]:
+            break
+        size = measurement["n"]
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scalar vs batch geometry benchmarks")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=239)
+    parser.add_argument("--output", help="save results to this JSON file")
+    args = parser.parse_args()
+
+    results = runGeometryBenchmarks(args.repeats, args.seed)
+    for name, measurements in results.items():
+        print(name)
+        for measurement in measurements:
+            print("  n={n:<5} scalar {scalar:10.3e} s, kernel {kernel:10.3e} s, x{ratio:.1f}"
+                  .format(ratio=measurement["scalar"] / measurement["kernel"], **measurement))
+        print("  crossover: n={}".format(crossover(measurements)))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({"results": results, "crossover": {name: crossover(measurements) for name, measurements in results.items()}},
+                      file, indent=2)
+        print("Results saved to {}".format(args.output))
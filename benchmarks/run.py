@@ -0,0 +1,216 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+
+from benchmarks.scenario import SCALES, generateScenario
+
+
+# Usage (from the repository root):
+#   python -m benchmarks.run --scale small --output bench.json
+#   python -m benchmarks.run --scale small --output bench_new.json --baseline bench.json --threshold 1.25
+# With --baseline the exit code is 1 if the median time of any benchmark is more than threshold times slower.
+# Every benchmark gets its own threshold from the spread of its samples (worst / median * margin, not less than --threshold),
+# it is saved with the results and used when they are the baseline; --threshold is used for benchmarks without one.
+
+
+def measure(function, repeats, setup=None):
+    # one untimed call first, so that imports and first-call caches are not in the samples
+    function(setup() if setup is not None else None)
+    times = []
+    for _ in range(repeats):
+        state = setup() if setup is not None else None
+        started = time.perf_counter()
+        function(state)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def loadScenario(paths, mission_step):
+    from world import World
+    from station import load_stations
+    from mission import load_missions
+
+    world = World(paths["world"], 1000)
+    control_station, charge_stations = load_stations(paths["stations"])
+    world.addStations(control_station, charge_stations)
+    missions = load_missions(paths["missions"], mission_step, control_station, world)
+    return world, control_station, charge_stations, missions
+
+
+def freshSwarm(world, paths, control_station, charge_stations, missions, time_budget):
+    # new drones and mission queue, so that benchmarks which change swarm state can be repeated
+    from drone import load_drones
+    from mission import MissionPoly, MissionSplitter
+    from mission_queue import MissionQueue
+    from scheduler import EventScheduler
+
+    drones = load_drones(paths["drones"], control_station.x, control_station.y, world)
+    world.addDrones(drones)
+    splitter = MissionSplitter(time_budget, drones)
+    mission_list = []
+    for mission in missions:
+        if isinstance(mission, MissionPoly):
+            mission.waypoint_visited[:] = False
+            mission.n_waypoints_visited = 0
+            mission_list += splitter.split(mission)
+        else:
+            mission.waypoint_visited = [False for _ in mission.waypoints]
+            mission.n_waypoints_visited = 0
+            mission_list.append(mission)
+    for i, mission in enumerate(mission_list):
+        mission.key = i + 1
+    mission_queue = MissionQueue(mission_list)
+    scheduler = EventScheduler(world, mission_queue, charge_stations)
+    for key, drone in drones.items():
+        drone.setMissionList(mission_queue)
+        drone.setScheduler(scheduler)
+    return drones, mission_queue, scheduler
+
+
+def reachablePairs(world, n, rng):
+    component = max(nx.connected_components(world.g), key=len)
+    vertices = np.array(sorted(component))
+    pairs = []
+    for start, finish in rng.choice(vertices, (n, 2)):
+        (i0, j0), (i1, j1) = world.fromVertexId(int(start)), world.fromVertexId(int(finish))
+        pairs.append(((i0 + 0.5) * world.dem_resolution, (j0 + 0.5) * world.dem_resolution,
+                      (i1 + 0.5) * world.dem_resolution, (j1 + 0.5) * world.dem_resolution))
+    return pairs
+
+
+def runBenchmarks(scale, repeats, n_paths, n_ticks, seed=239):
+    from utils import simplifyPath
+    from mission import MissionPoly, rasterizePolygon, splitMission
+    from eventlog import events
+    events.disable()
+
+    mission_step = 200
+    time_budget = 1000
+    results = {}
+
+    def record(name, times):
+        results[name] = {"median": statistics.median(times), "best": min(times), "worst": max(times), "repeats": len(times)}
+        print("  {:<40} median {:.6f} s, best {:.6f} s".format(name, results[name]["median"], results[name]["best"]), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as scenario_dir:
+        paths = generateScenario(scenario_dir, seed=seed, **SCALES[scale])
+        with contextlib.redirect_stdout(io.StringIO()):
+            world, control_station, charge_stations, missions = loadScenario(paths, mission_step)
+            rng = np.random.default_rng(seed)
+
+            record("prepair_path_planning", measure(lambda _: world.prepairPathPlanning(), max(1, repeats // 3)))
+
+            pairs = reachablePairs(world, n_paths, rng)
+
+            def estimatePaths(_):
+                for pair in pairs:
+                    world.estimatePath(*pair)
+
+            def clearCache():
+                world.cachedPaths = {}
+            record("estimate_path_cold", measure(estimatePaths, repeats, clearCache))
+            record("estimate_path_warm", measure(estimatePaths, repeats))
+
+            dense_paths = []
+            for x0, y0, x1, y1 in pairs[:10]:
+                vertices = nx.shortest_path(world.g, world.toVertexId(x0 // world.dem_resolution, y0 // world.dem_resolution),
+                                            world.toVertexId(x1 // world.dem_resolution, y1 // world.dem_resolution), weight='weight')
+                dense_paths.append([((i + 0.5) * world.dem_resolution, (j + 0.5) * world.dem_resolution)
+                                    for i, j in map(world.fromVertexId, vertices)])
+            record("simplify_path", measure(lambda _: [simplifyPath(xys, world.dem_resolution / 4.0) for xys in dense_paths], repeats))
+
+            poly_missions = [mission for mission in missions if isinstance(mission, MissionPoly)]
+            record("rasterize_polygon", measure(lambda _: [rasterizePolygon(mission.polygon, mission_step, world) for mission in poly_missions], repeats))
+            record("split_mission", measure(lambda _: [splitMission(mission, time_budget, 6) for mission in poly_missions], repeats))
+
+            def swarm():
+                return freshSwarm(world, paths, control_station, charge_stations, missions, time_budget)
+            drones, _, _ = swarm()
+            record("generate_wireless_network_spanning_tree", measure(lambda _: world.generateWirelessNetworkSpanningTree(), repeats))
+
+            def schedule(state):
+                drones, mission_queue, scheduler = state
+                master_drone = world.getMasterDrone()
+                master_drone.tryToScheduleTasks(drones, charge_stations, world)
+            schedule(swarm())  # warms up path cache for the first assignments
+            record("try_to_schedule_tasks", measure(schedule, repeats, swarm))
+
+            def ticks(state):
+                drones, mission_queue, scheduler = state
+                dt = world.simulation_step
+                for _ in range(n_ticks):
+                    scheduler.tick()
+                    for key in sorted(drones.keys()):
+                        drones[key].update(world, dt)
+            record("headless_ticks_x{}".format(n_ticks), measure(ticks, max(1, repeats // 3), swarm))
+
+    return results
+
+
+def thresholdsOf(results, margin, threshold):
+    # noisy benchmarks get a wider limit: the worst sample over the median, with a margin
+    thresholds = {}
+    for name, result in sorted(results.items()):
+        spread = result["worst"] / result["median"] if result["median"] > 0 else 1.0
+        thresholds[name] = round(max(threshold, spread * margin), 2)
+    return thresholds
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    thresholds = baseline.get("thresholds", {})
+    for name, result in sorted(results.items()):
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["median"]
+        ratio = result["median"] / before if before > 0 else float("inf")
+        limit = thresholds.get(name, threshold)
+        status = "REGRESSION" if ratio > limit else "ok"
+        print("{:<40} {:10.6f} -> {:10.6f} s  x{:.2f} (limit x{:.2f}) {}".format(name, before, result["median"], ratio, limit, status))
+        if ratio > limit:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drones Swarm Simulator benchmarks")
+    parser.add_argument("--scale", choices=sorted(SCALES.keys()), default="small")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--paths", type=int, default=20, help="number of random path queries")
+    parser.add_argument("--ticks", type=int, default=200, help="number of headless simulation ticks")
+    parser.add_argument("--seed", type=int, default=239)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="previous results to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25, help="allowed slowdown ratio of median time, the lowest per-benchmark threshold")
+    parser.add_argument("--margin", type=float, default=1.2, help="per-benchmark threshold is worst / median time of samples times margin")
+    args = parser.parse_args()
+
+    print("Running {} benchmarks...".format(args.scale), file=sys.stderr)
+    results = runBenchmarks(args.scale, args.repeats, args.paths, args.ticks, args.seed)
+    report = {"meta": {"scale": args.scale, "repeats": args.repeats, "paths": args.paths, "ticks": args.ticks, "seed": args.seed,
+                       "python": platform.python_version(), "numpy": np.__version__, "networkx": nx.__version__,
+                       "machine": platform.machine(), "timestamp": time.time()},
+              "thresholds": thresholdsOf(results, args.margin, args.threshold),
+              "results": results}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print("Results saved to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        if baseline["meta"]["scale"] != args.scale or baseline["meta"]["seed"] != args.seed:
+            print("Warning: baseline was measured on another scenario ({} scale, seed {})".format(baseline["meta"]["scale"], baseline["meta"]["seed"]))
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
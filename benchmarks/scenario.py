@@ -0,0 +1,98 @@
+import json
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+
+# Synthetic scenario generator: DEM with random hills, stations, drones fleet and missions,
+# written in the same format as data/*.json so that the regular loaders can be used.
+
+SCALES = {
+    # dem size (pixels), drones, polygon missions, path missions, patrol missions
+    "small": dict(dem_size=100, n_drones=8, n_poly_missions=4, n_path_missions=8, n_patrol_missions=2),
+    "medium": dict(dem_size=225, n_drones=32, n_poly_missions=12, n_path_missions=32, n_patrol_missions=6),
+    "large": dict(dem_size=400, n_drones=128, n_poly_missions=40, n_path_missions=128, n_patrol_missions=16),
+}
+
+PAYLOADS = ["agro", "highresCamera", "patrolCamera", "cargo"]
+
+
+def generateDEM(size, n_hills, maximum_allowed_height, rng):
+    # smooth background with gaussian hills, about 10% of pixels are above maximum_allowed_height
+    ys, xs = np.mgrid[0:size, 0:size].astype(np.float64)
+    dem = np.full((size, size), 0.3 * maximum_allowed_height)
+    for _ in range(n_hills):
+        cx, cy = rng.uniform(0, size, 2)
+        radius = rng.uniform(0.02, 0.08) * size
+        height = rng.uniform(0.5, 1.1) * maximum_allowed_height
+        dem += height * np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (2 * radius * radius))
+    return np.clip(dem, 0, 255).astype(np.uint8)
+
+
+def freePoint(dem_mask, resolution, rng, margin=1):
+    size = dem_mask.shape[0]
+    while True:
+        i, j = rng.integers(margin, size - margin, 2)
+        if not dem_mask[j, i]:
+            return float((i + 0.5) * resolution), float((j + 0.5) * resolution)
+
+
+def generateScenario(output_dir, dem_size, n_drones, n_poly_missions, n_path_missions, n_patrol_missions,
+                     resolution=100.0, seed=239):
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    maximum_allowed_height = 227
+    extent = dem_size * resolution
+
+    dem = generateDEM(dem_size, max(4, dem_size // 10), maximum_allowed_height, rng)
+    dem_path = os.path.join(output_dir, "dem.png")
+    Image.fromarray(dem).save(dem_path)
+    # the same rule as World.estimateProhibitedDEMMask
+    dem_mask = dem > maximum_allowed_height
+
+    world = {"world": {"dem_resolution": resolution, "dem_path": dem_path, "maximum_allowed_height": maximum_allowed_height,
+                       "simulation_step": 10, "wireless_range": extent / 2, "charge_power": 10}}
+
+    stations = [{"type": "control", "x": 0, "y": 0}]
+    stations[0]["x"], stations[0]["y"] = freePoint(dem_mask, resolution, rng)
+    for _ in range(max(2, n_drones // 8)):
+        x, y = freePoint(dem_mask, resolution, rng)
+        stations.append({"type": "charge", "x": x, "y": y})
+
+    drones = []
+    for k in range(n_drones):
+        payload = [PAYLOADS[k % len(PAYLOADS)], PAYLOADS[(k * 7 + 3) % len(PAYLOADS)]]
+        if k == 0:
+            payload = list(PAYLOADS)
+        drone = {"isMaster": k == 0, "payload": sorted(set(payload)), "speed": float(rng.uniform(4, 10)),
+                 "lifetime": float(rng.uniform(0.5, 1.0) * 4 * extent / 6)}
+        if "agro" in drone["payload"]:
+            drone["payloadAgroVolume"] = 4000
+        drones.append(drone)
+
+    missions = []
+    for _ in range(n_poly_missions):
+        cx, cy = freePoint(dem_mask, resolution, rng)
+        w, h = rng.uniform(0.05, 0.2, 2) * extent
+        angle = rng.uniform(0, math.pi)
+        corners = [(-w / 2, -h / 2), (w / 2, -h / 2), (w / 2, h / 2), (-w / 2, h / 2)]
+        polygon = [[float(np.clip(cx + x * math.cos(angle) - y * math.sin(angle), 0, extent - 1)),
+                    float(np.clip(cy + x * math.sin(angle) + y * math.cos(angle), 0, extent - 1))] for x, y in corners]
+        if rng.random() < 0.5:
+            missions.append({"type": "agro", "agroVolumePerSecond": 1.0, "polygon": polygon})
+        else:
+            missions.append({"type": "highresCamera", "polygon": polygon})
+    for _ in range(n_path_missions):
+        missions.append({"type": "cargo", "destination": list(freePoint(dem_mask, resolution, rng))})
+    for _ in range(n_patrol_missions):
+        missions.append({"type": "patrolCamera", "patrolpolygon": [list(freePoint(dem_mask, resolution, rng)) for _ in range(3)]})
+
+    paths = {}
+    for name, data in [("world", world), ("stations", {"stations": stations}), ("drones", {"drones": drones}),
+                       ("missions", {"missions": missions})]:
+        paths[name] = os.path.join(output_dir, name + ".json")
+        with open(paths[name], "w") as file:
+            json.dump(data, file, indent=2)
+    return paths
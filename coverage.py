@@ -0,0 +1,260 @@
+import math
+import numpy as np
+
+from utils import pointsInPolygon
+from mission import rasterizePolygon
+
+
+# Coverage path planning for polygon missions.
+# For every candidate sweep direction (0, 90 degrees and the directions of polygon edges) the polygon is rotated
+# so that sweep lines are horizontal, rasterized with the same grid as rasterizePolygon (in the rotated frame, so for 0 degrees
+# the waypoints are exactly the same), split into cells with boustrophedon decomposition (a new cell starts whenever
+# the number of row intervals changes) and cells are ordered greedily to minimize transit between them.
+# Transit legs that stay inside of the polygon and off prohibited DEM pixels are preferred, unavoidable legs over
+# prohibited pixels are routed with World.estimatePath. All candidates cover the same polygon, so directions are compared
+# by total (length + turns cost) and not per waypoint (a rotated grid may place more waypoints over the same area),
+# a direction that covers fewer waypoints than the plain zig-zag is never chosen.
+# Plain rasterizePolygon zig-zag is always one of candidates, so the result is never worse than it.
+
+
+def rotate(xs, ys, angle):
+    c, s = math.cos(angle), math.sin(angle)
+    return xs * c - ys * s, xs * s + ys * c
+
+
+def pathLength(waypoints):
+    if len(waypoints) < 2:
+        return 0.0
+    return float(np.linalg.norm(np.diff(np.float64(waypoints), axis=0), axis=1).sum())
+
+
+def countTurns(waypoints):
+    if len(waypoints) < 3:
+        return 0
+    directions = np.diff(np.float64(waypoints), axis=0)
+    cross = directions[:-1, 0] * directions[1:, 1] - directions[:-1, 1] * directions[1:, 0]
+    dot = (directions[:-1] * directions[1:]).sum(axis=1)
+    return int(np.count_nonzero(np.abs(np.arctan2(cross, dot)) > 1e-3))
+
+
+def pathCost(waypoints, turn_cost):
+    return pathLength(waypoints) + turn_cost * countTurns(waypoints)
+
+
+def rowIntervals(is_inside_row):
+    # [(first, last)] indices of runs of True values
+    padded = np.concatenate([[False], is_inside_row, [False]])
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(changes[0::2], changes[1::2] - 1))
+
+
+def boustrophedonCells(is_inside):
+    # cells are lists of (row, first, last) intervals, each interval of a cell overlaps only the previous one
+    cells = []
+    prev_intervals, prev_cells = [], []
+    for row in range(is_inside.shape[0]):
+        intervals = rowIntervals(is_inside[row])
+        overlaps = [[k for k, (a, b) in enumerate(prev_intervals) if a <= last and first <= b] for first, last in intervals]
+        overlap_counts = [0] * len(prev_intervals)
+        for ks in overlaps:
+            for k in ks:
+                overlap_counts[k] += 1
+
+        row_cells = []
+        for (first, last), ks in zip(intervals, overlaps):
+            if len(ks) == 1 and overlap_counts[ks[0]] == 1:
+                cell = prev_cells[ks[0]]
+            else:
+                cell = []
+                cells.append(cell)
+            cell.append((row, first, last))
+            row_cells.append(cell)
+        prev_intervals, prev_cells = intervals, row_cells
+    return cells
+
+
+def cellPath(cell, grid_xs, grid_ys, reverse_rows, start_left):
+    rows = cell[::-1] if reverse_rows else cell
+    xs, ys = [], []
+    left_to_right = start_left
+    for row, first, last in rows:
+        row_xs = grid_xs[row, first:last + 1]
+        row_ys = grid_ys[row, first:last + 1]
+        if not left_to_right:
+            row_xs, row_ys = row_xs[::-1], row_ys[::-1]
+        xs.append(row_xs)
+        ys.append(row_ys)
+        left_to_right = not left_to_right
+    return np.stack([np.concatenate(xs), np.concatenate(ys)], axis=1)
+
+
+class TransitLegs:
+
+    # transit between cells: straight if it stays inside of the polygon and off prohibited pixels,
+    # otherwise it is avoided when possible, and if it crosses prohibited pixels - routed with World.estimatePath
+    def __init__(self, polygon, step, world=None):
+        self.polygon = polygon
+        self.step = step
+        self.world = world
+        self.clear = {}  # (x0, y0, x1, y1) -> leg is clear
+
+    def isClear(self, a, b):
+        key = (float(a[0]), float(a[1]), float(b[0]), float(b[1]))
+        if key not in self.clear:
+            n = max(1, int(np.linalg.norm(b - a) / (self.step / 4.0)))
+            ts = np.linspace(0.0, 1.0, n + 1)
+            is_inside = pointsInPolygon(a[0] + (b[0] - a[0]) * ts, a[1] + (b[1] - a[1]) * ts, self.polygon).all()
+            self.clear[key] = bool(is_inside) and not (self.world is not None and self.world.isRouteBlocked([tuple(a), tuple(b)]))
+        return self.clear[key]
+
+    def route(self, a, b):
+        # intermediate waypoints between a and b
+        if self.world is None or not self.world.isRouteBlocked([tuple(a), tuple(b)]):
+            return np.zeros((0, 2))
+        return np.float64(self.world.estimatePath(float(a[0]), float(a[1]), float(b[0]), float(b[1]))[1:-1]).reshape(-1, 2)
+
+
+def orderCells(cell_variants, start, legs):
+    # greedy nearest neighbour over cells, each cell can be entered in any of its variants, clear legs first
+    order = [start]
+    path = cell_variants[start[0]][start[1]]
+    visited = {start[0]}
+    while len(visited) < len(cell_variants):
+        exit_point = path[-1]
+        best, best_key = None, None
+        for i, variants in enumerate(cell_variants):
+            if i in visited:
+                continue
+            for j, variant in enumerate(variants):
+                key = (not legs.isClear(exit_point, variant[0]), np.linalg.norm(variant[0] - exit_point))
+                if best_key is None or key < best_key:
+                    best, best_key = (i, j), key
+        visited.add(best[0])
+        order.append(best)
+        entry = cell_variants[best[0]][best[1]]
+        path = np.concatenate([path, legs.route(exit_point, entry[0]), entry])
+    return path
+
+
+def sweepPath(polygon, step, angle, world=None, max_start_cells=16):
+    polygon_xy = np.float64(polygon)
+    px, py = rotate(polygon_xy[:, 0], polygon_xy[:, 1], -angle)
+    # rounding keeps points lying exactly on axis-aligned borders outside of polygon after rotation by 90 degrees
+    px, py = np.round(px, 6), np.round(py, 6)
+    rotated_polygon = list(zip(px, py))
+
+    # the same grid as rasterizePolygon, so that for 0 degrees both cover the same waypoints
+    xs = np.arange(px.min(), px.max(), step)
+    ys = np.arange(py.min(), py.max(), step)
+    grid_xs, grid_ys = np.meshgrid(xs, ys)
+    is_inside = pointsInPolygon(grid_xs, grid_ys, rotated_polygon)
+    world_xs, world_ys = rotate(grid_xs, grid_ys, angle)
+
+    if world is not None:
+        mask = world.dem_prohibited_mask
+        pixel_i = np.floor(world_xs / world.dem_resolution).astype(np.int64)
+        pixel_j = np.floor(world_ys / world.dem_resolution).astype(np.int64)
+        is_in_dem = (pixel_i >= 0) & (pixel_i < mask.shape[1]) & (pixel_j >= 0) & (pixel_j < mask.shape[0])
+        is_prohibited = np.ones_like(is_inside)
+        is_prohibited[is_in_dem] = mask[pixel_j[is_in_dem], pixel_i[is_in_dem]]
+        is_inside &= ~is_prohibited
+
+    cells = boustrophedonCells(is_inside)
+    if len(cells) == 0:
+        return np.zeros((0, 2)), 0
+    cell_variants = [[cellPath(cell, world_xs, world_ys, reverse_rows, start_left)
+                      for reverse_rows in (False, True) for start_left in (False, True)] for cell in cells]
+
+    legs = TransitLegs(polygon, step, world)
+    best_path, best_length = None, None
+    for i in range(min(len(cells), max_start_cells)):
+        for j in range(len(cell_variants[i])):
+            path = orderCells(cell_variants, (i, j), legs)
+            length = pathLength(path)
+            if best_length is None or length < best_length:
+                best_path, best_length = path, length
+    # returns path and number of covered waypoints (without transit ones)
+    return best_path, int(np.count_nonzero(is_inside))
+
+
+def candidateAngles(polygon):
+    angles = {0.0: 0.0, round(math.pi / 2, 9): math.pi / 2}  # rounded angle -> angle
+    n = len(polygon)
+    for i in range(n):
+        x0, y0 = polygon[i]
+        x1, y1 = polygon[(i + 1) % n]
+        if (x0, y0) != (x1, y1):
+            angle = math.atan2(y1 - y0, x1 - x0) % math.pi
+            angles.setdefault(round(angle, 9), angle)
+    return [angles[key] for key in sorted(angles.keys())]
+
+
+def planCoveragePath(polygon, step, world=None, turn_cost=None):
+    # returns list of (x, y) waypoints covering polygon with the same density as rasterizePolygon
+    if turn_cost is None:
+        turn_cost = step
+    best_path = np.float64(rasterizePolygon(polygon, step, world)).reshape(-1, 2)
+    n_zigzag = len(best_path)
+    best_cost = pathCost(best_path, turn_cost)
+    for angle in candidateAngles(polygon):
+        path, n_covered = sweepPath(polygon, step, angle, world)
+        if n_covered < n_zigzag:
+            # rotated grid may lose some points near the border - do not trade coverage for length
+            continue
+        cost = pathCost(path, turn_cost)
+        if cost < best_cost:
+            best_path, best_cost = path, cost
+    return list(map(tuple, best_path.tolist()))
+
+
+if __name__ == '__main__':
+    # compares flight time of plain zig-zag and of planned coverage path on bundled scenario
+    import json
+    from mission import polySquare
+    from drone import load_drones
+    from mission import MissionSplitter
+    from world import World
+
+    world = World("data/world.json", 1000)
+    drones = load_drones("data/drones.json", 0, 0, world)
+    speeds = MissionSplitter.fleetSpeeds(drones)
+    with open("data/missions.json", "r") as file:
+        missions_data = json.load(file)["missions"]
+
+    mission_step = 500
+    hectares_per_waypoint = mission_step * mission_step / 10000.0
+    total_before, total_after, total_hectares = 0.0, 0.0, 0.0
+    for i, mission_data in enumerate(missions_data):
+        if "rect" not in mission_data and "polygon" not in mission_data:
+            continue
+        polygon = polySquare(mission_data["rect"]) if "rect" in mission_data else mission_data["polygon"]
+        speed = speeds[mission_data["type"]]
+        zigzag = rasterizePolygon(polygon, mission_step, world)
+        planned = planCoveragePath(polygon, mission_step, world)
+        time_before, time_after = pathLength(zigzag) / speed, pathLength(planned) / speed
+        total_before += time_before
+        total_after += time_after
+        # both are divided by the area of the same rasterizePolygon grid, transit waypoints of the planned path cover nothing new
+        hectares = len(zigzag) * hectares_per_waypoint
+        total_hectares += hectares
+        print("mission {} ({}): {} -> {} waypoints, {} -> {} turns, flight time {:.0f} s -> {:.0f} s, {:.1f} -> {:.1f} s/ha".format(
+            i + 1, mission_data["type"], len(zigzag), len(planned), countTurns(zigzag), countTurns(planned),
+            time_before, time_after, time_before / hectares, time_after / hectares))
+    # synthetic fields for reference: rotated strip and non-convex U-shaped field
+    c, s = math.cos(math.pi / 5), math.sin(math.pi / 5)
+    synthetic_polygons = {
+        "rotated strip": [(5000 + x * c - y * s, 5000 + x * s + y * c) for x, y in [(0, 0), (12000, 0), (12000, 2500), (0, 2500)]],
+        "U-shaped field": [(0, 0), (10000, 0), (10000, 10000), (7000, 10000), (7000, 3000), (3000, 3000), (3000, 10000), (0, 10000)],
+    }
+    for name, polygon in synthetic_polygons.items():
+        zigzag = rasterizePolygon(polygon, mission_step)
+        planned = planCoveragePath(polygon, mission_step)
+        print("synthetic {}: {} -> {} waypoints, {} -> {} turns, path {:.0f} m -> {:.0f} m, {:.0f} -> {:.0f} m/ha".format(
+            name, len(zigzag), len(planned), countTurns(zigzag), countTurns(planned), pathLength(zigzag), pathLength(planned),
+            pathLength(zigzag) / (len(zigzag) * hectares_per_waypoint), pathLength(planned) / (len(zigzag) * hectares_per_waypoint)))
+
+    per_hectare_before = total_before / total_hectares
+    per_hectare_after = total_after / total_hectares
+    print("total: flight time {:.0f} s -> {:.0f} s, {:.2f} -> {:.2f} s/ha ({:.1f}% saved per hectare)".format(
+        total_before, total_after, per_hectare_before, per_hectare_after,
+        100.0 * (per_hectare_before - per_hectare_after) / per_hectare_before))
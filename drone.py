@@ -1,8 +1,14 @@
 import json
 import random
 
+import numpy as np
+
 from mission import Mission, MissionPoly, MissionPath, MissionPatrol
 from utils import *
+from geometry import distancesTo, segmentsIntersect
+from metrics import metrics
+from eventlog import events, MissionAssigned, MissionStarted, CollisionPause, LowBattery, AgroPayloadEmpty, OnCharge, \
+    ChargeFinished, Charged, AgroPayloadRefilled
 
 
 class Drone:
@@ -24,6 +30,8 @@ class Drone:
         self.lifetime_left = drone_data["lifetime"]
         self.charge_power = charge_power
         self.mission_list = []
+        self.scheduler = None
+        self.network = None
         self.flying = False
 
         if "payloadAgroVolume" in drone_data:
@@ -37,15 +45,29 @@ class Drone:
 
         self.state = "wait"
 
-    # now one object shared between all drones
-    # TODO only master holds mission list, other drones request updates over network
+    # by default one object (see MissionQueue) shared between all drones,
+    # with SwarmNetwork only master holds mission queue and other drones get MissionListProxy
     def setMissionList(self, mission_list):
         self.mission_list = mission_list
 
+    def setNetwork(self, network):
+        self.network = network
+
+    def setScheduler(self, scheduler):
+        self.scheduler = scheduler
+        if self.needTask():
+            self.scheduler.notifyDroneIdle(self)
+
+    def notifyIdle(self):
+        if self.scheduler is not None:
+            self.scheduler.notifyDroneIdle(self)
 
     def distanceTo(self, x, y):
         return dist(x - self.x, y - self.y)
 
+    def label(self):
+        return "{} {}".format(self.key + ("M" if self.is_master else ""), self.state)
+
     def timeTo(self, x, y):
         distance = self.distanceTo(x, y)
         return distance / self.speed
@@ -69,13 +91,25 @@ class Drone:
     def fly(self, world, dt):
         nextX, nextY = self.predictNextPosition(dt)
 
-        for key, that in world.drones.items():
-            assert key == that.key
-            thatNextX, thatNextY = that.predictNextPosition(dt)
-            if isIntersects(self.x, self.y, nextX, nextY, that.x, that.y, thatNextX, thatNextY):
-                if self.key < that.key:
-                    print("Drone {}: PAUSE! Collision avoidance with Drone {}!".format(self.key, that.key))
-                    nextX, nextY = self.x, self.y
+        if world.tile_engine is not None:
+            # collisions were already checked by tile jobs, see TileEngine.planMoves
+            for that_key in world.tile_engine.collisionsOf(self):
+                events.emit(CollisionPause, self.key, that_key)
+                nextX, nextY = self.x, self.y
+        else:
+            metrics.inc("collision_pair_tests", len(world.drones))
+            with metrics.phase("collision_checks"):
+                # only drones with larger keys make this drone give way, after a pause its move is empty and can't intersect,
+                # so only the first collision matters
+                others = [that for key, that in world.drones.items() if self.key < key]
+                if len(others) > 0:
+                    others_next = [that.predictNextPosition(dt) for that in others]
+                    intersects = segmentsIntersect(self.x, self.y, nextX, nextY,
+                                                   np.array([that.x for that in others]), np.array([that.y for that in others]),
+                                                   np.array([xy[0] for xy in others_next]), np.array([xy[1] for xy in others_next]))
+                    if intersects.any():
+                        events.emit(CollisionPause, self.key, others[int(np.argmax(intersects))].key)
+                        nextX, nextY = self.x, self.y
 
         self.x, self.y = nextX, nextY
         if self.x == self.targetX and self.y == self.targetY:
@@ -92,10 +126,10 @@ class Drone:
                 return
 
             if self.state == "flyToMission":
-                print("Drone {}: executing mission {}...".format(self.key, self.targetMission.key))
+                events.emit(MissionStarted, self.key, self.targetMission.key)
                 self.state = "onMission"
             elif self.state == "flyToCharge":
-                print("Drone {}: on charge...".format(self.key))
+                events.emit(OnCharge, self.key)
                 self.state = "onCharge"
                 self.flying = False
             else:
@@ -107,7 +141,7 @@ class Drone:
         if self.targetMission.type == "agro":
             self.payloadAgroVolumeLeft -= self.targetMission.agroVolumePerSecond * dt
             if self.payloadAgroVolumeLeft < 0.0:
-                print("Drone {}: fail, we are on mission but have no agro payload left!".format(self.key))
+                events.emit(AgroPayloadEmpty, self.key)
         if self.targetMission.finished():
             # print("Drone {}: mission {} finished".format(self.key, self.targetMission.key))
             if isinstance(self.targetMission, MissionPatrol):
@@ -115,6 +149,7 @@ class Drone:
                 self.mission_list.append(self.targetMission)
             self.targetMission = None
             self.state = "wait"
+            self.notifyIdle()
         elif self.targetMission.hasNextWaypoint():
             # print("Drone {}: mission {} going to next waypoint".format(self.key, self.targetMission.key))
             self.state = "flyToMission"
@@ -125,14 +160,15 @@ class Drone:
         assert self.state == "onCharge"
         self.lifetime_left = min(self.max_lifetime, self.lifetime_left + self.charge_power * dt)
         if self.lifetime_left == self.max_lifetime:
-            print("Drone {}: charge finished".format(self.key))
+            events.emit(ChargeFinished, self.key)
             if self.targetMission is None:
-                print("Drone {}: charged! waiting...".format(self.key))
+                events.emit(Charged, self.key)
                 self.state = "wait"
+                self.notifyIdle()
             else:
                 raise Exception("this branch should not be touched")
         if self.payloadAgroVolumeLeft != self.payloadAgroVolume:
-            print("Drone {}: Agro payload updated to {}!".format(self.key, self.payloadAgroVolume))
+            events.emit(AgroPayloadRefilled, self.key, self.payloadAgroVolume)
             self.payloadAgroVolumeLeft = self.payloadAgroVolume
 
     def timeToClosestChargeStationFrom(self, x, y, charge_stations):
@@ -159,16 +195,28 @@ class Drone:
         closest_station, smallest_time_to_reach = self.timeToClosestChargeStationFrom(self.x, self.y, charge_stations)
 
         if smallest_time_to_reach >= self.lifetime_left:
-            print("Drone {}: low battery, flying to station {}".format(self.key, closest_station.key))
-            self.state = "flyToCharge"
+            events.emit(LowBattery, self.key, closest_station.key)
             if self.targetMission is not None:
                 self.mission_list.append(self.targetMission)
                 self.targetMission = None
 
-            path = world.estimatePath(self.x, self.y, closest_station.x, closest_station.y)
-            self.pathPlannerMission = MissionPath(0, "", path)
-            self.targetX = self.pathPlannerMission.nextWaypoint()[0]
-            self.targetY = self.pathPlannerMission.nextWaypoint()[1]
+            self.flyToStation(closest_station, world)
+
+    def flyToStation(self, station, world):
+        self.state = "flyToCharge"
+        self.followPath(world, station.x, station.y)
+
+    def followPath(self, world, x, y):
+        # route from the current position to (x, y), with AnytimePlanner it is planned within a time budget
+        if world.anytime_planner is not None:
+            world.anytime_planner.planRoute(self, x, y)
+        else:
+            self.setRoute(world.estimatePath(self.x, self.y, x, y))
+
+    def setRoute(self, path):
+        self.pathPlannerMission = MissionPath(0, "", path)
+        self.targetX = self.pathPlannerMission.nextWaypoint()[0]
+        self.targetY = self.pathPlannerMission.nextWaypoint()[1]
 
     def update(self, world, dt):
         if self.state not in {"flyToCharge", "onCharge"}:
@@ -189,10 +237,7 @@ class Drone:
                 if len(reachable_drones) < len(world.drones):
                     furthest_station, largest_time_to_reach = self.timeToFurthestChargeStationFrom(self.x, self.y, world.charge_stations)
                     if self.lifetime_left >= largest_time_to_reach:
-                        path = world.estimatePath(self.x, self.y, furthest_station.x, furthest_station.y)
-                        self.pathPlannerMission = MissionPath(0, "", path)
-                        self.targetX = self.pathPlannerMission.nextWaypoint()[0]
-                        self.targetY = self.pathPlannerMission.nextWaypoint()[1]
+                        self.followPath(world, furthest_station.x, furthest_station.y)
                         self.state = "flyToCharge"
         else:
             raise Exception("state={} is incorrect!".format(self.state))
@@ -200,25 +245,40 @@ class Drone:
         if self.flying:
             self.lifetime_left -= dt
 
+    def canExecute(self, mission, charge_stations):
+        if mission.type not in self.payload:
+            return False
+        time_to_start = self.timeTo(*mission.getFirstWaypoint())
+        time_to_execute = mission.getTotalLength() / self.speed
+        if mission.type == "agro" and self.payloadAgroVolumeLeft < time_to_execute * mission.agroVolumePerSecond:
+            return False
+        _, time_to_charge = self.timeToClosestChargeStationFrom(*mission.getLastWaypoint(), charge_stations)
+        return time_to_start + time_to_execute + time_to_charge <= self.lifetime_left
+
     def needTask(self):
         return self.targetMission is None and self.state in {"wait"}
 
     def addTask(self, mission, world):
         assert self.needTask()
 
-        print("Drone {}: new mission {}".format(self.key, mission.key))
+        events.emit(MissionAssigned, self.key, mission.key)
+        if self.network is not None:
+            self.network.publishAssign(mission, self)
         self.flying = True
         self.targetMission = mission
         if self.state in {"wait"}:
             self.state = "flyToMission"
 
-            path = world.estimatePath(self.x, self.y, mission.nextWaypoint()[0], mission.nextWaypoint()[1])
-            self.pathPlannerMission = MissionPath(0, "", path)
-            self.targetX = self.pathPlannerMission.nextWaypoint()[0]
-            self.targetY = self.pathPlannerMission.nextWaypoint()[1]
+            self.followPath(world, mission.nextWaypoint()[0], mission.nextWaypoint()[1])
 
-    def tryToScheduleTasks(self, available_drones, charge_stations, world):
-        assert self.is_master
+    def tryToScheduleTasks(self, available_drones, charge_stations, world, idle_drones=None, mission_list=None):
+        # idle_drones - if specified, only these drones get new tasks (see EventScheduler), otherwise all available drones
+        # mission_list - missions partition of a local coordinator (see ShardedScheduler), otherwise master's mission list
+        assert self.is_master or mission_list is not None
+        if idle_drones is None:
+            idle_drones = available_drones.values()
+        if mission_list is None:
+            mission_list = self.mission_list
 
         # This is an algorithm similar to Hungarian algorithm - https://en.wikipedia.org/wiki/Hungarian_algorithm
         # we want to split missions between drones with "cheapest cost"
@@ -227,48 +287,68 @@ class Drone:
         progress = True
         while progress:
             progress = False
-            missions = list(filter(lambda mission: mission.hasNextWaypoint(), self.mission_list))
-            drones = list(filter(lambda drone: drone.needTask(), available_drones.values()))
+            metrics.inc("scheduler_iterations")
+            drones = list(filter(lambda drone: drone.needTask(), idle_drones))
             drones_on_mission = list(filter(lambda drone: drone.targetMission is not None, available_drones.values()))
             INF = 1e12
             try_to_take_far_mission_from_others_weight = 0.25
-            costs_matrix = [[INF] * len(missions)] * len(drones)
-            win_j, win_i, win_cost = -1, -1, INF
-            for j, drone in enumerate(drones):
-                for i, mission in enumerate(missions):
-                    if mission.type not in drone.payload:
-                        continue
-
-                    time_to_start = drone.timeTo(*mission.getFirstWaypoint())
-                    time_to_execute = mission.getTotalLength() / drone.speed
-                    if mission.type == "agro" and drone.payloadAgroVolumeLeft < time_to_execute * mission.agroVolumePerSecond:
-                        continue
-                    _, time_to_charge = self.timeToClosestChargeStationFrom(*mission.getLastWaypoint(), charge_stations)
-                    total_time = time_to_start + time_to_execute + time_to_charge
-                    if total_time > drone.lifetime_left:
-                        # this drone can't finish this mission part
-                        continue
-
-                    closest_mission_finish_time = INF
-                    for another_drone in drones_on_mission:
-                        assert another_drone.targetMission is not None
-                        another_drone_time_to_finish = another_drone.targetMission.getTotalLength() / another_drone.speed
-                        another_drone_time_to_start = distbetween(*another_drone.targetMission.getLastWaypoint(), *mission.getFirstWaypoint()) / another_drone.speed
-                        another_drone_time_to_execute = mission.getTotalLength() / another_drone.speed
-                        _, another_drone_time_to_charge = another_drone.timeToClosestChargeStationFrom(*mission.getLastWaypoint(), charge_stations)
-                        another_drone_time = another_drone_time_to_finish + another_drone_time_to_start + another_drone_time_to_execute + another_drone_time_to_charge
-                        another_drone_can_take_the_same_mission = another_drone_time < another_drone.lifetime_left
-                        if another_drone_can_take_the_same_mission:
-                            closest_mission_finish_time = min(another_drone_time_to_start, closest_mission_finish_time)
-
-                    cost = time_to_start + time_to_execute - closest_mission_finish_time * try_to_take_far_mission_from_others_weight
-                    costs_matrix[j][i] = cost
-                    if cost < win_cost:
-                        win_j, win_i, win_cost = j, i, cost
-            if win_j != -1 and win_i != -1:
-                mission = missions[win_i]
-                drones[win_j].addTask(mission, world)
-                self.mission_list.remove(mission)
+            # only the closest missions with a suitable payload are considered for each drone (see MissionQueue.nearestFeasible),
+            # more of them only if none of these can be executed with the drone's battery and agro payload
+            nearest_missions_per_drone = 16
+            win_drone, win_mission, win_cost = None, None, INF
+
+            # drones on missions and stations as arrays, to evaluate each mission against all of them at once
+            others_speed = np.array([another_drone.speed for another_drone in drones_on_mission])
+            others_x = np.array([another_drone.targetMission.getLastWaypoint()[0] for another_drone in drones_on_mission])
+            others_y = np.array([another_drone.targetMission.getLastWaypoint()[1] for another_drone in drones_on_mission])
+            others_time_to_finish = np.array([another_drone.targetMission.getTotalLength() / another_drone.speed
+                                              for another_drone in drones_on_mission])
+            others_lifetime_left = np.array([another_drone.lifetime_left for another_drone in drones_on_mission])
+            stations_x = [station.x for station in charge_stations.values()]
+            stations_y = [station.y for station in charge_stations.values()]
+            distance_to_charge = {}  # mission key -> distance from its last waypoint to the closest charge station
+
+            for drone in drones:
+                # the search is widened until a feasible mission is found or all queued missions were considered
+                k, seen, has_feasible = nearest_missions_per_drone, set(), False
+                while True:
+                    nearest = mission_list.nearestFeasible(drone, k)
+                    for mission in nearest:
+                        if id(mission) in seen:
+                            continue
+                        seen.add(id(mission))
+                        time_to_start = drone.timeTo(*mission.getFirstWaypoint())
+                        time_to_execute = mission.getTotalLength() / drone.speed
+                        if mission.type == "agro" and drone.payloadAgroVolumeLeft < time_to_execute * mission.agroVolumePerSecond:
+                            continue
+                        if mission.key not in distance_to_charge:
+                            distance_to_charge[mission.key] = float(distancesTo(*mission.getLastWaypoint(), stations_x, stations_y).min())
+                        time_to_charge = distance_to_charge[mission.key] / self.speed
+                        total_time = time_to_start + time_to_execute + time_to_charge
+                        if total_time > drone.lifetime_left:
+                            # this drone can't finish this mission part
+                            continue
+                        has_feasible = True
+
+                        closest_mission_finish_time = INF
+                        if len(drones_on_mission) > 0:
+                            others_time_to_start = distancesTo(*mission.getFirstWaypoint(), others_x, others_y) / others_speed
+                            others_time_to_execute = mission.getTotalLength() / others_speed
+                            others_time_to_charge = distance_to_charge[mission.key] / others_speed
+                            others_time = others_time_to_finish + others_time_to_start + others_time_to_execute + others_time_to_charge
+                            others_can_take_the_same_mission = others_time < others_lifetime_left
+                            if others_can_take_the_same_mission.any():
+                                closest_mission_finish_time = float(others_time_to_start[others_can_take_the_same_mission].min())
+
+                        cost = time_to_start + time_to_execute - closest_mission_finish_time * try_to_take_far_mission_from_others_weight
+                        if cost < win_cost:
+                            win_drone, win_mission, win_cost = drone, mission, cost
+                    if has_feasible or len(nearest) < k:
+                        break
+                    k *= 2
+            if win_drone is not None:
+                win_drone.addTask(win_mission, world)
+                mission_list.remove(win_mission)
                 progress = True
 
 
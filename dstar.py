@@ -0,0 +1,108 @@
+import heapq
+
+INF = float("inf")
+
+
+# D* Lite (Koenig, Likhachev 2002, optimized version) over an undirected networkx adjacency.
+# The search is rooted at the goal, so one planner is reused by all drones flying to the same goal (f.e. charge station)
+# and after graph edges change (see World.addNoFlyZone) only vertices around changed edges are repaired
+# instead of replanning from scratch. Start may be moved to any vertex between searches.
+class DStarLite:
+
+    def __init__(self, adj, goal, heuristic):
+        self.adj = adj  # graph adjacency (f.e. networkx Graph.adj), changes in place
+        self.goal = goal
+        self.heuristic = heuristic  # heuristic(u, v) - consistent lower bound of path cost between vertices
+        self.g = {}
+        self.rhs = {goal: 0.0}
+        self.km = 0.0
+        self.start = None
+        self.heap = []
+        self.open = {}  # vertex -> its actual key in heap, other heap entries of the vertex are outdated
+        self.pending = set()  # vertices with changed edges, applied in the next plan()
+        self.expansions = 0
+        self.push(goal)
+
+    def calculateKey(self, u):
+        value = min(self.g.get(u, INF), self.rhs.get(u, INF))
+        return (value + self.heuristic(self.start, u) + self.km if self.start is not None else value, value)
+
+    def push(self, u):
+        key = self.calculateKey(u)
+        self.open[u] = key
+        heapq.heappush(self.heap, (key, u))
+
+    def neighbors(self, u):
+        if u not in self.adj:
+            return {}
+        return self.adj[u]
+
+    def updateVertex(self, u):
+        if u != self.goal:
+            best = INF
+            for v, data in self.neighbors(u).items():
+                best = min(best, data['weight'] + self.g.get(v, INF))
+            self.rhs[u] = best
+        if self.g.get(u, INF) != self.rhs.get(u, INF):
+            self.push(u)
+        else:
+            self.open.pop(u, None)
+
+    def computeShortestPath(self):
+        while self.heap:
+            key_old, u = self.heap[0]
+            if self.open.get(u) != key_old:
+                heapq.heappop(self.heap)
+                continue
+            start_key = self.calculateKey(self.start)
+            if key_old >= start_key and self.rhs.get(self.start, INF) == self.g.get(self.start, INF):
+                break
+            heapq.heappop(self.heap)
+            self.expansions += 1
+            key_new = self.calculateKey(u)
+            if key_old < key_new:
+                self.push(u)
+            elif self.g.get(u, INF) > self.rhs.get(u, INF):
+                self.g[u] = self.rhs[u]
+                self.open.pop(u, None)
+                for v in self.neighbors(u):
+                    self.updateVertex(v)
+            else:
+                self.g[u] = INF
+                self.open.pop(u, None)
+                self.updateVertex(u)
+                for v in self.neighbors(u):
+                    self.updateVertex(v)
+
+    def edgesChanged(self, vertices):
+        self.pending.update(vertices)
+
+    def plan(self, start):
+        # returns vertices [start, ..., goal] or None if goal is unreachable
+        if self.start is None:
+            self.start = start
+            # keys were calculated without start, recalculate them
+            for u in list(self.open.keys()):
+                self.push(u)
+        elif start != self.start:
+            self.km += self.heuristic(self.start, start)
+            self.start = start
+        for u in sorted(self.pending):
+            self.updateVertex(u)
+        self.pending = set()
+        self.computeShortestPath()
+
+        if self.g.get(start, INF) == INF:
+            return None
+        path = [start]
+        while path[-1] != self.goal:
+            u = path[-1]
+            best, best_v = INF, None
+            for v, data in self.neighbors(u).items():
+                cost = data['weight'] + self.g.get(v, INF)
+                if cost < best:
+                    best, best_v = cost, v
+            if best_v is None or len(path) > len(self.g) + 1:
+                return None
+            path.append(best_v)
+        return path
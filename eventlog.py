@@ -0,0 +1,200 @@
+import atexit
+import collections
+import json
+import sys
+import threading
+import time
+
+
+# Structured event log for simulation hot paths (instead of print).
+# emit() only checks whether the event type passes level/category filters and appends (time, type, args)
+# to a ring buffer, formatting and I/O are done in batches by a background thread.
+# If the buffer overflows (f.e. output is much slower than the simulation) - the oldest events are dropped and counted.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+
+class Event:
+    level = INFO
+    category = "system"
+    message = "{}"
+
+
+class MissionAssigned(Event):
+    category = "mission"
+    message = "Drone {}: new mission {}"
+
+
+class MissionStarted(Event):
+    category = "mission"
+    message = "Drone {}: executing mission {}..."
+
+
+class CollisionPause(Event):
+    level = DEBUG
+    category = "collision"
+    message = "Drone {}: PAUSE! Collision avoidance with Drone {}!"
+
+
+class LowBattery(Event):
+    category = "battery"
+    message = "Drone {}: low battery, flying to station {}"
+
+
+class AgroPayloadEmpty(Event):
+    level = WARNING
+    category = "battery"
+    message = "Drone {}: fail, we are on mission but have no agro payload left!"
+
+
+class OnCharge(Event):
+    category = "charge"
+    message = "Drone {}: on charge..."
+
+
+class ChargeFinished(Event):
+    category = "charge"
+    message = "Drone {}: charge finished"
+
+
+class Charged(Event):
+    category = "charge"
+    message = "Drone {}: charged! waiting..."
+
+
+class AgroPayloadRefilled(Event):
+    category = "charge"
+    message = "Drone {}: Agro payload updated to {}!"
+
+
+class RouteRepaired(Event):
+    category = "navigation"
+    message = "Drone {}: route crosses a no-fly zone, repaired ({} pixels)"
+
+
+class RouteBlocked(Event):
+    level = WARNING
+    category = "navigation"
+    message = "Drone {}: route crosses a no-fly zone and can't be repaired!"
+
+
+class NoFlyZonesUpdated(Event):
+    category = "navigation"
+    message = "No-fly zones: {} edges removed, {} edges added, {} cached paths invalidated"
+
+
+class MissionRejected(Event):
+    level = WARNING
+    category = "mission"
+    message = "Inbox: rejected mission {}: {}"
+
+
+class ComponentMerged(Event):
+    category = "mission"
+    message = "Scheduler: component of drone {} merged with master: {} missions returned, {} claims reconciled"
+
+
+EVENT_TYPES = [MissionAssigned, MissionStarted, CollisionPause, LowBattery, AgroPayloadEmpty, OnCharge, ChargeFinished,
+               Charged, AgroPayloadRefilled, RouteRepaired, RouteBlocked, NoFlyZonesUpdated, MissionRejected,
+               ComponentMerged]
+CATEGORIES = sorted(set(event_type.category for event_type in EVENT_TYPES))
+
+
+class EventLog:
+
+    def __init__(self, capacity=65536, flush_period=0.2):
+        self.buffer = collections.deque(maxlen=capacity)
+        self.flush_period = flush_period  # seconds
+        self.enabled_types = set()
+        self.sink = sys.stdout
+        self.format = "text"
+        self.thread = None
+        self.atexit_registered = False
+        self.lock = threading.Lock()  # serializes flushes of the background thread and of stop()
+        self.stopped = threading.Event()
+
+        self.emitted = 0
+        self.dropped = 0
+        self.flushed = 0
+
+        self.configure()
+
+    def configure(self, level=INFO, categories=None, sink=None, format=None):
+        # level=None disables the log, categories=None enables all categories
+        self.enabled_types = set()
+        if level is not None:
+            for event_type in EVENT_TYPES:
+                if event_type.level >= level and (categories is None or event_type.category in categories):
+                    self.enabled_types.add(event_type)
+        if sink is not None:
+            self.sink = sink
+        if format is not None:
+            assert format in {"text", "jsonl"}
+            self.format = format
+
+    def disable(self):
+        self.configure(level=None)
+
+    def isEnabled(self, event_type):
+        return event_type in self.enabled_types
+
+    def emit(self, event_type, *args):
+        if event_type not in self.enabled_types:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((time.time(), event_type, args))
+        self.emitted += 1
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="eventlog", daemon=True)
+        self.thread.start()
+        if not self.atexit_registered:
+            atexit.register(self.stop)
+            self.atexit_registered = True
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_period):
+            self.flush()
+
+    def formatRecord(self, record):
+        timestamp, event_type, args = record
+        if self.format == "jsonl":
+            return json.dumps({"time": timestamp, "event": event_type.__name__, "level": LEVEL_NAMES[event_type.level],
+                               "category": event_type.category, "args": [arg if isinstance(arg, (int, float)) else str(arg) for arg in args]})
+        return event_type.message.format(*args)
+
+    def flush(self):
+        with self.lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self.buffer.popleft())
+                except IndexError:
+                    break
+            if len(batch) == 0:
+                return
+            self.sink.write("".join(self.formatRecord(record) + "\n" for record in batch))
+            self.sink.flush()
+            self.flushed += len(batch)
+
+    def stats(self):
+        return {"emitted": self.emitted, "dropped": self.dropped, "flushed": self.flushed, "buffered": len(self.buffer)}
+
+
+events = EventLog()
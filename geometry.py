@@ -0,0 +1,67 @@
+import numpy as np
+
+
+# Batch geometry kernels: the same predicates as scalar helpers in utils, but for many points/segments at once.
+# All kernels work in float64 (coordinates are up to tens of kilometers, float32 loses centimeters to decimeters there).
+# For a handful of elements scalar helpers are faster (see benchmarks/geometry.py for the crossover sizes).
+
+
+def asArray(values):
+    return np.asarray(values, dtype=np.float64)
+
+
+def norm(dx, dy):
+    # sqrt(x*x + y*y) instead of hypot - bitwise the same results as utils.dist
+    return np.sqrt(dx * dx + dy * dy)
+
+
+def pairwiseDistances(xs0, ys0, xs1, ys1):
+    # (n0, n1) matrix of distances between points (xs0[i], ys0[i]) and (xs1[j], ys1[j])
+    xs0, ys0, xs1, ys1 = asArray(xs0), asArray(ys0), asArray(xs1), asArray(ys1)
+    return norm(xs0[:, None] - xs1[None, :], ys0[:, None] - ys1[None, :])
+
+
+def distancesTo(x, y, xs, ys):
+    # distances from one point to many points
+    return norm(asArray(xs) - x, asArray(ys) - y)
+
+
+def distancesPointToSegments(px, py, ax, ay, bx, by):
+    # distances from point(s) p to segments [a, b], arguments are broadcastable, degenerated segments are points
+    px, py, ax, ay, bx, by = asArray(px), asArray(py), asArray(ax), asArray(ay), asArray(bx), asArray(by)
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length2 > 0, ((px - ax) * dx + (py - ay) * dy) / length2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return norm(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def segmentsIntersect(ax, ay, bx, by, cx, cy, dx, dy):
+    # the same predicate as utils.isIntersects (see https://stackoverflow.com/a/9997374), arguments are broadcastable
+    def ccw(ax, ay, bx, by, cx, cy):
+        return (cy - ay) * (bx - ax) > (by - ay) * (cx - ax)
+
+    return (ccw(ax, ay, cx, cy, dx, dy) != ccw(bx, by, cx, cy, dx, dy)) & (ccw(ax, ay, bx, by, cx, cy) != ccw(ax, ay, bx, by, dx, dy))
+
+
+def nearestPoints(x, y, xs, ys, k=1):
+    # indices of k points closest to (x, y) sorted by distance (ties - by index) and their distances
+    distances = distancesTo(x, y, xs, ys)
+    k = min(k, len(distances))
+    if k < len(distances):
+        candidates = np.argpartition(distances, k - 1)[:k]
+    else:
+        candidates = np.arange(len(distances))
+    order = candidates[np.lexsort((candidates, distances[candidates]))]
+    return order, distances[order]
+
+
+def polylineLength(xys):
+    # xys - sequence of (x, y) points
+    xys = asArray(xys)
+    if len(xys) < 2:
+        return 0.0
+    deltas = np.diff(xys, axis=0)
+    # cumsum sums sequentially, the same as a python loop
+    return float(np.cumsum(norm(deltas[:, 0], deltas[:, 1]))[-1])
@@ -0,0 +1,145 @@
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from eventlog import events, MissionRejected
+from metrics import metrics
+from mission import MissionPoly, MissionPart, parse_mission, rasterizePolygon
+
+
+# Streaming mission ingestion while the simulation is running.
+# Missions are submitted as JSON lines (the same objects as in data/missions.json "missions" list)
+# either appended to a JSONL file or sent to a local TCP socket. A background worker parses, rasterizes and splits them,
+# and the main loop appends ready missions to the master's queue between ticks with drain().
+
+
+class MissionInbox:
+
+    def __init__(self, world, splitter, step, coverage_planner=rasterizePolygon, jsonl_path=None, port=None, poll_period=0.5):
+        assert jsonl_path is not None or port is not None
+        self.world = world
+        self.splitter = splitter
+        self.step = step
+        self.coverage_planner = coverage_planner
+        self.jsonl_path = jsonl_path
+        self.port = port
+        self.poll_period = poll_period  # seconds between checks of JSONL file for new lines
+
+        self.received = queue.Queue()  # (received time, line)
+        self.ready = queue.Queue()  # (received time, mission, [parts])
+        self.stopped = threading.Event()
+        self.threads = []
+        self.server = None
+
+        self.missions_received = 0
+        self.missions_added = 0
+        self.missions_rejected = 0
+        self.last_latency = None  # seconds from receiving a line to appending the mission to the queue
+        self.max_latency = None
+        self.total_latency = 0.0
+
+    def start(self):
+        if self.jsonl_path is not None:
+            self.threads.append(threading.Thread(target=self.tailFile, name="inbox-tail", daemon=True))
+        if self.port is not None:
+            inbox = self
+
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    for line in self.rfile:
+                        inbox.receive(line.decode("utf-8"))
+
+            self.server = socketserver.ThreadingTCPServer(("127.0.0.1", self.port), Handler)
+            self.server.daemon_threads = True
+            self.threads.append(threading.Thread(target=self.server.serve_forever, name="inbox-socket", daemon=True))
+        self.threads.append(threading.Thread(target=self.work, name="inbox-worker", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        print("Inbox: listening to {}".format(", ".join(filter(None, [self.jsonl_path, self.port and "127.0.0.1:{}".format(self.port)]))))
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.received.put(None)
+
+    def receive(self, line):
+        line = line.strip()
+        if len(line) > 0:
+            self.received.put((time.time(), line))
+
+    def tailFile(self):
+        existed = os.path.exists(self.jsonl_path)  # lines written before the start are not new missions
+        while not os.path.exists(self.jsonl_path) and not self.stopped.is_set():
+            self.stopped.wait(self.poll_period)
+        with open(self.jsonl_path, "r") as file:
+            if existed:
+                file.seek(0, os.SEEK_END)
+            pending = ""
+            while not self.stopped.is_set():
+                chunk = file.readline()
+                if chunk == "":
+                    self.stopped.wait(self.poll_period)
+                    continue
+                pending += chunk
+                if pending.endswith("\n"):  # otherwise the line is still being written
+                    self.receive(pending)
+                    pending = ""
+
+    def work(self):
+        while True:
+            item = self.received.get()
+            if item is None:
+                return
+            received_time, line = item
+            self.missions_received += 1
+            try:
+                mission = parse_mission(json.loads(line), None, self.step, self.world, self.coverage_planner)
+                if isinstance(mission, MissionPoly):
+                    parts = [MissionPart(None, mission, begin, end)
+                             for begin, end in self.splitter.splitRanges(mission, 0, len(mission.waypoints))]
+                else:
+                    parts = [mission]
+            except Exception as e:
+                self.missions_rejected += 1
+                metrics.inc("missions_rejected")
+                events.emit(MissionRejected, line, e)
+                continue
+            self.ready.put((received_time, mission, parts))
+
+    def backlog(self):
+        # missions received but not yet appended to the master's queue
+        return self.received.qsize() + self.ready.qsize()
+
+    def stats(self):
+        return {"received": self.missions_received, "added": self.missions_added, "rejected": self.missions_rejected,
+                "backlog": self.backlog(), "last_latency": self.last_latency, "max_latency": self.max_latency,
+                "mean_latency": self.total_latency / self.missions_added if self.missions_added > 0 else None}
+
+    def drain(self, mission_queue):
+        # called from the simulation loop between ticks, returns newly added missions (not split, for drawing)
+        added = []
+        while True:
+            try:
+                received_time, mission, parts = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            for part in parts:
+                part.key = self.splitter.next_key
+                self.splitter.next_key += 1
+            if isinstance(mission, MissionPoly):
+                mission.key = parts[0].key if len(parts) > 0 else None
+                self.splitter.addParts(mission, parts)
+            for part in parts:
+                mission_queue.append(part)
+            latency = time.time() - received_time
+            self.last_latency = latency
+            self.max_latency = latency if self.max_latency is None else max(self.max_latency, latency)
+            self.total_latency += latency
+            self.missions_added += 1
+            added.append(mission)
+        return added
@@ -2,34 +2,157 @@ from station import load_stations
 from drone import load_drones
 from world import World
 import colors
-from mission import Mission, MissionPoly, MissionPath, splitMission, load_missions, MissionPatrol
+from mission import Mission, MissionPoly, MissionPath, MissionSplitter, load_missions, MissionPatrol, rasterizePolygon
+from mission_queue import MissionQueue
+from scheduler import EventScheduler, ShardedScheduler
+from planner import PlannerService
+from coverage import planCoveragePath
+from inbox import MissionInbox
+from metrics import metrics
+from eventlog import events, LEVELS, CATEGORIES
+from telemetry import TelemetryRecorder, TelemetryReplay
+from tiles import TileEngine
+from network import SwarmNetwork, TRANSPORTS
+from anytime import AnytimePlanner
+import argparse
+import json
 import random
+import sys
+import time
 
 import cv2
 
 
+def replay(path, window_height):
+    # draws recorded telemetry without simulation and without building navigation graph
+    recording = TelemetryReplay(path)
+    world = World(recording.meta["world"], window_height, prepair_path_planning=False)
+    control_station, charge_stations = load_stations(recording.meta["stations"])
+    world.addStations(control_station, charge_stations)
+    world.addDrones(recording.drones)
+
+    window_name = "Drones Swarm Simulator - replay"
+    cv2.namedWindow(window_name, (cv2.WINDOW_AUTOSIZE if window_height < 1200 else cv2.WINDOW_NORMAL) | cv2.WINDOW_KEEPRATIO | cv2.WINDOW_GUI_NORMAL)
+
+    print("__________________________________")
+    print("Replaying {} ticks from {}".format(len(recording), path))
+    print("Controls:")
+    print(" SPACE - pause/unpause")
+    print(" +/-   - speedup/slowdown replay")
+    print(" r     - reverse direction")
+    print(" ,/.   - one tick backward/forward")
+    print(" [/]   - jump 10% backward/forward")
+    print("__________________________________")
+
+    is_paused = False
+    speed = 1.0  # ticks per frame, may be fractional
+    direction = 1
+    position = 0.0
+    dem_frame = world.drawDEM()
+    while True:
+        tick = int(min(max(position, 0), len(recording) - 1))
+        recording.seek(tick)
+
+        frame = dem_frame.copy()
+        world.drawStations(frame)
+        world.drawDrones(frame)
+        status = "PAUSE (press SPACE BAR)" if is_paused else "x{:g}{}".format(speed, "" if direction > 0 else " reversed")
+        cv2.putText(frame, "{} tick {}/{} t={:.0f}s".format(status, tick + 1, len(recording), recording.time(tick)),
+                    (0, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, colors.BLACK, 1, 2)
+        cv2.imshow(window_name, frame)
+
+        if not is_paused:
+            position = min(max(position + direction * speed, 0), len(recording) - 1)
+
+        key = cv2.waitKey(1000//60)
+        if key == 27:  # Escape
+            break
+        elif key == 32:  # Space bar
+            is_paused = not is_paused
+        elif key == 43:  # +
+            speed *= 2
+        elif key == 45:  # -
+            speed /= 2
+        elif key == ord('r'):
+            direction = -direction
+        elif key == ord(','):
+            position = max(tick - 1, 0)
+        elif key == ord('.'):
+            position = min(tick + 1, len(recording) - 1)
+        elif key == ord('['):
+            position = max(tick - len(recording) // 10, 0)
+        elif key == ord(']'):
+            position = min(tick + len(recording) // 10, len(recording) - 1)
+    cv2.destroyAllWindows()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drones Swarm Simulator")
+    parser.add_argument("--async-planner", action="store_true", help="plan assignments with look-ahead in a worker process")
+    parser.add_argument("--inbox", help="JSONL file to tail for new missions while simulation is running")
+    parser.add_argument("--inbox-port", type=int, help="local TCP port to receive new missions as JSON lines")
+    parser.add_argument("--log-level", choices=sorted(LEVELS.keys()) + ["off"], default="info", help="drones events log level")
+    parser.add_argument("--log-categories", help="comma-separated events categories to log, any of: {}".format(",".join(CATEGORIES)))
+    parser.add_argument("--log-file", help="write drones events to this file (JSON lines if it ends with .jsonl)")
+    parser.add_argument("--record", help="record per-tick telemetry to this directory")
+    parser.add_argument("--replay", help="replay telemetry recorded with --record instead of simulation")
+    parser.add_argument("--metrics", help="enable tick profiler and dump metrics to this file (.json or .prom)")
+    parser.add_argument("--tiles", help="split pair tests of each tick into spatial tiles of this grid, f.e. 4x4")
+    parser.add_argument("--network", choices=sorted(TRANSPORTS.keys()), help="only master holds the mission queue, drones sync it with messages over this transport")
+    parser.add_argument("--warmup-workers", type=int, help="precompute paths between stations and mission parts ends at start with this many worker processes (0 - in the main process)")
+    parser.add_argument("--no-fly-zones", help="JSON with temporary no-fly zones (polygon, start and finish simulation time)")
+    parser.add_argument("--sharded", type=int, metavar="WORKERS", help="schedule every wireless network component with its own coordinator, components are scheduled by this many threads (0 - in the main thread)")
+    parser.add_argument("--plan-budget", type=float, help="time budget of path planning in milliseconds, not exact paths are refined in the background")
+    parser.add_argument("--refine-workers", type=int, default=1, help="worker processes refining paths for --plan-budget (0 - in the main process, one budget per tick)")
+    parser.add_argument("--coverage-planner", action="store_true", help="cover polygon missions with boustrophedon cells in the best sweep direction instead of plain zig-zag")
+    parser.add_argument("--metrics-window", type=float, default=10.0, help="metrics rollup window in seconds")
+    args = parser.parse_args()
+    events.configure(level=None if args.log_level == "off" else LEVELS[args.log_level],
+                     categories=args.log_categories.split(",") if args.log_categories is not None else None,
+                     sink=open(args.log_file, "w") if args.log_file is not None else None,
+                     format="jsonl" if args.log_file is not None and args.log_file.endswith(".jsonl") else None)
+    if args.metrics is not None:
+        metrics.enable(window=args.metrics_window, dump_path=args.metrics)
+
     window_height = 1000
+    if args.replay is not None:
+        replay(args.replay, window_height)
+        sys.exit(0)
 
     world = World("data/world.json", window_height)
     control_station, charge_stations = load_stations("data/stations.json")
     drones = load_drones("data/drones.json", control_station.x, control_station.y, world)
 
     mission_step = 500
-    mission_list = load_missions("data/missions.json", mission_step, control_station, world)
+    polygon_planner = planCoveragePath if args.coverage_planner else rasterizePolygon
+    mission_list = load_missions("data/missions.json", mission_step, control_station, world, polygon_planner)
+    mission_splitter = MissionSplitter(1000, drones)
+    poly_missions = []
     mission_list_split = []
     for mission in mission_list:
         if isinstance(mission, MissionPoly):
-            mission_list_split += splitMission(mission, 1000, 8)
+            poly_missions.append(mission)
+            mission_list_split += mission_splitter.split(mission)
         else:
             mission_list_split.append(mission)
     mission_list = mission_list_split
     for i, mission in enumerate(mission_list):
         mission.key = i+1
+    mission_splitter.next_key = len(mission_list) + 1
 
     world.addDrones(drones)
     world.addStations(control_station, charge_stations)
 
+    if args.warmup_workers is not None:
+        started = time.time()
+        stations_xys = [(control_station.x, control_station.y)] + [(station.x, station.y) for station in charge_stations.values()]
+        waypoints_xys = set()
+        for mission in mission_list:
+            for x, y in (mission.getFirstWaypoint(), mission.getLastWaypoint()):
+                waypoints_xys.add((float(x), float(y)))
+        n_paths = world.warmUpPaths(stations_xys, sorted(waypoints_xys), args.warmup_workers)
+        print("Path cache warmed up: {} paths in {:.1f} s".format(n_paths, time.time() - started))
+
     window_name = "Drones Swarm Simulator"
     cv2.namedWindow(window_name, (cv2.WINDOW_AUTOSIZE if window_height < 1200 else cv2.WINDOW_NORMAL) | cv2.WINDOW_KEEPRATIO | cv2.WINDOW_GUI_NORMAL)
 
@@ -44,21 +167,69 @@ if __name__ == '__main__':
     print(" +/-   - speedup/slowdown simulation")
     print("__________________________________")
 
-    poly_missions = []
     path_missions = []
     patrol_missions = []
     for mission in mission_list:
         if isinstance(mission, MissionPath):
             path_missions.append(mission)
-        if isinstance(mission, MissionPoly):
-            poly_missions.append(mission)
         if isinstance(mission, MissionPatrol):
             patrol_missions.append(mission)
 
     # mission_list = [Mission(key + 1, 10000, random.random() * 22500, random.random() * 22500) for key in range(10)]
 
+    mission_queue = MissionQueue(mission_list)
+    if args.sharded is not None:
+        scheduler = ShardedScheduler(world, mission_queue, charge_stations, args.sharded)
+    else:
+        scheduler = EventScheduler(world, mission_queue, charge_stations)
     for key, drone in drones.items():
-        drone.setMissionList(mission_list)
+        drone.setMissionList(mission_queue)
+        drone.setScheduler(scheduler)
+    network = None
+    if args.network is not None:
+        network = SwarmNetwork(world, drones, mission_queue, args.network)
+        network.attach()
+    planner = PlannerService(world, mission_queue, charge_stations, scheduler) if args.async_planner else None
+
+    inbox = None
+    if args.inbox is not None or args.inbox_port is not None:
+        inbox = MissionInbox(world, mission_splitter, mission_step, polygon_planner, args.inbox, args.inbox_port)
+        inbox.start()
+
+    engine = None
+    if args.tiles is not None:
+        tiles_x, tiles_y = map(int, args.tiles.split("x"))
+        engine = TileEngine(world, drones, tiles_x, tiles_y)
+        world.tile_engine = engine
+
+    anytime_planner = None
+    if args.plan_budget is not None:
+        anytime_planner = AnytimePlanner(world, args.plan_budget / 1000.0, args.refine_workers)
+        world.anytime_planner = anytime_planner
+
+    no_fly_zones = []
+    if args.no_fly_zones is not None:
+        with open(args.no_fly_zones, "r") as file:
+            no_fly_zones = json.load(file)["zones"]
+    active_no_fly_zones = {}  # index in no_fly_zones -> key in world
+
+    active_fleet_keys = frozenset(drones.keys())  # drones which are not charging, missions are split for them
+
+    recorder = TelemetryRecorder(args.record, drones, "data/world.json", "data/stations.json") if args.record is not None else None
+    simulation_time = 0.0
+
+    metrics.addSource("scheduler", scheduler.stats)
+    metrics.addSource("eventlog", events.stats)
+    if planner is not None:
+        metrics.addSource("planner", planner.stats)
+    if inbox is not None:
+        metrics.addSource("inbox", inbox.stats)
+    if engine is not None:
+        metrics.addSource("tiles", engine.stats)
+    if network is not None:
+        metrics.addSource("network", network.stats)
+    if anytime_planner is not None:
+        metrics.addSource("anytime", anytime_planner.stats)
 
     while True:
         frame = world.drawDEM()
@@ -66,18 +237,60 @@ if __name__ == '__main__':
 
         if not is_paused:
             for step in range(steps_per_frame):
-                master_drone = world.getMasterDrone()
-                available_drones = world.getWirelessReachableDrones(master_drone)
-                master_drone.tryToScheduleTasks(available_drones, charge_stations, world)
-                for key in sorted(drones.keys()):
-                    drone = drones[key]
-                    drone.update(world, dt / slowdown)
+                with metrics.phase("tick"):
+                    for i, zone in enumerate(no_fly_zones):
+                        is_active = zone["start"] <= simulation_time < zone["finish"]
+                        if is_active and i not in active_no_fly_zones:
+                            active_no_fly_zones[i] = world.addNoFlyZone(zone["polygon"])
+                        elif not is_active and i in active_no_fly_zones:
+                            world.removeNoFlyZone(active_no_fly_zones.pop(i))
+                    if anytime_planner is not None:
+                        with metrics.phase("path_refinement"):
+                            anytime_planner.tick()
+                    if inbox is not None:
+                        with metrics.phase("inbox"):
+                            for mission in inbox.drain(mission_queue):
+                                if isinstance(mission, MissionPoly):
+                                    poly_missions.append(mission)
+                                if isinstance(mission, MissionPath):
+                                    path_missions.append(mission)
+                                if isinstance(mission, MissionPatrol):
+                                    patrol_missions.append(mission)
+                    fleet_keys = frozenset(key for key, drone in drones.items() if drone.state not in {"flyToCharge", "onCharge"})
+                    if fleet_keys != active_fleet_keys:
+                        active_fleet_keys = fleet_keys
+                        mission_splitter.updateFleet({key: drones[key] for key in sorted(fleet_keys)})
+                        new_parts = mission_splitter.resplit(mission_queue)
+                        if len(new_parts) > 0:
+                            print("Fleet changed: {} mission parts re-split".format(len(new_parts)))
+                    with metrics.phase("scheduling"):
+                        if planner is not None:
+                            planner.tick(dt / slowdown)
+                        else:
+                            scheduler.tick()
+                    with metrics.phase("drones_update"):
+                        if engine is not None:
+                            engine.updateDrones(dt / slowdown)
+                        else:
+                            for key in sorted(drones.keys()):
+                                drone = drones[key]
+                                drone.update(world, dt / slowdown)
+                    if network is not None:
+                        with metrics.phase("network"):
+                            network.tick()
+                    simulation_time += dt / slowdown
+                    if recorder is not None:
+                        with metrics.phase("telemetry"):
+                            recorder.record(simulation_time, drones)
+                metrics.inc("ticks")
 
-        world.drawStations(frame)
-        world.drawPolygonMissions(frame, poly_missions) #TODO move to world?
-        world.drawPathMissions(frame, path_missions) #TODO move to world?
-        world.drawPathMissions(frame, patrol_missions) #TODO move to world?
-        world.drawDrones(frame)
+        with metrics.phase("render"):
+            world.drawStations(frame)
+            world.drawPolygonMissions(frame, poly_missions) #TODO move to world?
+            world.drawPathMissions(frame, path_missions) #TODO move to world?
+            world.drawPathMissions(frame, patrol_missions) #TODO move to world?
+            world.drawDrones(frame)
+        metrics.rollup()
 
         cv2.putText(frame, "PAUSE (press SPACE BAR)" if is_paused else "x{}".format("1/{}".format(slowdown) if slowdown > 1 else steps_per_frame), (0, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, colors.BLACK, 1, 2)
 
@@ -106,3 +319,34 @@ if __name__ == '__main__':
             # print("GUI: Unhandled key: {}".format(key))
             pass
     cv2.destroyAllWindows()
+    events.stop()
+    if recorder is not None:
+        recorder.close()
+        print("Telemetry: {} ticks recorded to {}".format(recorder.ticks_recorded, args.record))
+    if args.metrics is not None:
+        metrics.dump(args.metrics)
+    if inbox is not None:
+        print("Inbox: {}".format(inbox.stats()))
+        inbox.stop()
+    if planner is not None:
+        planner.shutdown()
+        print("Planner: {}".format(planner.stats()))
+    if engine is not None:
+        print("Tiles: {}".format(engine.stats()))
+    if anytime_planner is not None:
+        anytime_planner.shutdown()
+        print("Path planning: {calls} calls, {cache_hits} cached, {exact} exact, {weighted} weighted, {fallbacks} fallbacks "
+              "({roadmap_failures} off the roadmap), "
+              "p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms, max {max_ms:.2f} ms (budget {budget_ms:.2f} ms, {deadline_misses} misses), "
+              "{swaps} refined paths swapped".format(**anytime_planner.stats()))
+    if network is not None:
+        network.shutdown()
+        print("Network: {}".format(network.stats()))
+        busiest_links = sorted(network.linkStats().items(), key=lambda item: -item[1]["bytes"])[:5]
+        for link, link_stats in busiest_links:
+            print("  link {}: {messages} messages, {bytes} bytes, {bytes_per_tick:.1f} bytes/tick".format(link, **link_stats))
+    print("Scheduling: {runs} runs, {skips} skipped ticks, {reachability_checks} reachability checks".format(**scheduler.stats()))
+    if args.sharded is not None:
+        scheduler.shutdown()
+        print("Sharded scheduling: {components} components, {component_runs} component runs, {leased} missions leased, "
+              "{returned} returned, {claimed} claimed, {reconciled} claims reconciled, {merges} merges, {expirations} leases expired".format(**scheduler.stats()))
@@ -0,0 +1,217 @@
+import collections
+import json
+import threading
+import time
+
+
+# Built-in instrumentation: phase timers and counters, rolled up over wall-clock time windows
+# and dumpable as JSON or as Prometheus text exposition. Disabled by default - then phase() returns a shared no-op
+# context manager and inc() returns right after the flag check, so instrumented hot paths pay almost nothing.
+#
+# Phases may nest (f.e. network_mst is measured inside of reachability and scheduling), so their times do not sum up.
+
+
+class NoopPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_PHASE = NoopPhase()
+
+
+class Phase:
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.addTime(self.name, time.perf_counter() - self.started)
+        return False
+
+
+# upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float("inf"))
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # upper bound of the bucket with q-th quantile, so the real quantile is not larger
+        if self.count == 0:
+            return 0.0
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def toDict(self):
+        return {"count": self.count, "seconds": self.sum, "p50_seconds": self.quantile(0.5), "p99_seconds": self.quantile(0.99),
+                "buckets": {repr(bound): count for bound, count in zip(LATENCY_BUCKETS, self.counts)}}
+
+
+class Window:
+
+    def __init__(self, started):
+        self.started = started
+        self.finished = None
+        self.phases = {}  # name -> [calls, total seconds, max seconds]
+        self.counters = collections.Counter()
+        self.histograms = {}  # name -> Histogram
+
+    def toDict(self):
+        return {"started": self.started, "finished": self.finished,
+                "phases": {name: {"calls": calls, "seconds": total, "max_seconds": max_time}
+                           for name, (calls, total, max_time) in sorted(self.phases.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {name: histogram.toDict() for name, histogram in sorted(self.histograms.items())}}
+
+
+class Metrics:
+
+    def __init__(self, window=10.0, windows_kept=60):
+        self.enabled = False
+        self.window = window  # seconds of wall time per rollup window
+        self.windows = collections.deque(maxlen=windows_kept)
+        self.current = Window(time.time())
+        self.totals = Window(time.time())
+        self.sources = {}  # name -> function returning dict of numeric values (f.e. EventScheduler.stats)
+        self.dump_path = None
+        self.lock = threading.Lock()  # counters may be updated from scheduler threads, see ShardedScheduler
+
+    def enable(self, enabled=True, window=None, dump_path=None):
+        self.enabled = enabled
+        if window is not None:
+            self.window = window
+        if dump_path is not None:
+            self.dump_path = dump_path
+        self.current = Window(time.time())
+
+    def addSource(self, name, stats_function):
+        self.sources[name] = stats_function
+
+    def phase(self, name):
+        if not self.enabled:
+            return NOOP_PHASE
+        return Phase(self, name)
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            for window in (self.current, self.totals):
+                stats = window.phases.get(name)
+                if stats is None:
+                    window.phases[name] = [1, seconds, seconds]
+                else:
+                    stats[0] += 1
+                    stats[1] += seconds
+                    stats[2] = max(stats[2], seconds)
+
+    def inc(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.current.counters[name] += n
+            self.totals.counters[name] += n
+
+    def observe(self, name, seconds):
+        # latency distributions (f.e. of time-budgeted path planning), phases keep only total and max
+        if not self.enabled:
+            return
+        with self.lock:
+            for window in (self.current, self.totals):
+                histogram = window.histograms.get(name)
+                if histogram is None:
+                    histogram = window.histograms[name] = Histogram()
+                histogram.observe(seconds)
+
+    def rollup(self):
+        # closes the current window if it is long enough, should be called once per frame/tick
+        if not self.enabled:
+            return
+        now = time.time()
+        if now - self.current.started < self.window:
+            return
+        with self.lock:
+            self.current.finished = now
+            self.windows.append(self.current)
+            self.current = Window(now)
+        if self.dump_path is not None:
+            self.dump(self.dump_path)
+
+    def sourcesValues(self):
+        values = {}
+        for name, stats_function in sorted(self.sources.items()):
+            values[name] = {key: value for key, value in stats_function().items()
+                            if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        return values
+
+    def toDict(self):
+        return {"enabled": self.enabled, "window": self.window, "totals": self.totals.toDict(),
+                "current_window": self.current.toDict(), "windows": [window.toDict() for window in self.windows],
+                "sources": self.sourcesValues()}
+
+    def toPrometheus(self, prefix="drones"):
+        lines = []
+
+        def metric(name, type, samples):
+            lines.append("# TYPE {}_{} {}".format(prefix, name, type))
+            for labels, value in samples:
+                lines.append("{}_{}{} {}".format(prefix, name, labels, repr(float(value))))
+
+        phases = sorted(self.totals.phases.items())
+        metric("phase_seconds_total", "counter", [('{{phase="{}"}}'.format(name), total) for name, (calls, total, max_time) in phases])
+        metric("phase_calls_total", "counter", [('{{phase="{}"}}'.format(name), calls) for name, (calls, total, max_time) in phases])
+        last_window = self.windows[-1] if len(self.windows) > 0 else self.current
+        metric("phase_window_max_seconds", "gauge",
+               [('{{phase="{}"}}'.format(name), max_time) for name, (calls, total, max_time) in sorted(last_window.phases.items())])
+        for name, value in sorted(self.totals.counters.items()):
+            metric("{}_total".format(name), "counter", [("", value)])
+        for name, histogram in sorted(self.totals.histograms.items()):
+            lines.append("# TYPE {}_{}_seconds histogram".format(prefix, name))
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append('{}_{}_seconds_bucket{{le="{}"}} {}'.format(prefix, name, "+Inf" if bound == float("inf") else repr(bound),
+                                                                         repr(float(cumulative))))
+            lines.append("{}_{}_seconds_sum {}".format(prefix, name, repr(float(histogram.sum))))
+            lines.append("{}_{}_seconds_count {}".format(prefix, name, repr(float(histogram.count))))
+        for source, values in self.sourcesValues().items():
+            for name, value in sorted(values.items()):
+                metric("{}_{}".format(source, name), "gauge", [("", value)])
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # format is chosen by extension: .prom/.txt - Prometheus text exposition, otherwise JSON
+        if path.endswith(".prom") or path.endswith(".txt"):
+            text = self.toPrometheus()
+        else:
+            text = json.dumps(self.toDict(), indent=2)
+        with open(path, "w") as file:
+            file.write(text)
+
+
+metrics = Metrics()
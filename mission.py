@@ -1,13 +1,8 @@
 import json
 import numpy as np
 
-from utils import distbetween
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
-
-from utils import distbetween
-
-import copy
+from utils import pointsInPolygon
+from geometry import polylineLength
 
 class Mission:
 
@@ -25,44 +20,87 @@ class Mission:
 
 
 
-def rasterizePolygon(polygon, step):
+def rasterizePolygon(polygon, step, world=None):
+    # zig-zag (boustrophedon) grid of waypoints inside polygon,
+    # if world is specified - waypoints in prohibited DEM pixels (mountains) are skipped
     assert polygon is not None and len(polygon) > 0
 
-    minx, miny = polygon[0]
-    maxx, maxy = minx, miny
-    for x, y in polygon:
-        minx = min(x, minx)
-        miny = min(y, miny)
-        maxx = max(x, maxx)
-        maxy = max(y, maxy)
+    polygon_xy = np.float64(polygon)
+    minx, miny = polygon_xy.min(axis=0)
+    maxx, maxy = polygon_xy.max(axis=0)
+
+    xs = np.arange(minx, maxx, step)
+    ys = np.arange(miny, maxy, step)
+    grid_xs, grid_ys = np.meshgrid(xs, ys)
+    is_inside = pointsInPolygon(grid_xs, grid_ys, polygon)
+
+    if world is not None:
+        mask = world.dem_prohibited_mask
+        pixel_i = np.floor(grid_xs / world.dem_resolution).astype(np.int64)
+        pixel_j = np.floor(grid_ys / world.dem_resolution).astype(np.int64)
+        is_in_dem = (pixel_i >= 0) & (pixel_i < mask.shape[1]) & (pixel_j >= 0) & (pixel_j < mask.shape[0])
+        is_prohibited = np.ones_like(is_inside)
+        is_prohibited[is_in_dem] = mask[pixel_j[is_in_dem], pixel_i[is_in_dem]]
+        is_inside &= ~is_prohibited
+
+    # even rows are swept right-to-left, odd rows - left-to-right
+    is_inside[0::2] = is_inside[0::2, ::-1]
+    grid_xs[0::2] = grid_xs[0::2, ::-1]
+    return list(zip(grid_xs[is_inside].tolist(), grid_ys[is_inside].tolist()))
 
-    waypoints = []
+class MissionPoly:
 
-    poly = Polygon(polygon)
+    # coverage_planner(polygon, step, world) -> waypoints, plain zig-zag by default, see also coverage.planCoveragePath
+    def __init__(self, key, type, polygon, step, agroVolumePerSecond=None, world=None, coverage_planner=rasterizePolygon):
+        self.key = key
+        self.type = type
+        self.polygon = polygon
+        # waypoints are stored in arrays, so mission parts can reference them without copying (see MissionPart)
+        self.waypoints = np.float64(coverage_planner(polygon, step, world)).reshape(-1, 2)
+        self.waypoint_visited = np.zeros(len(self.waypoints), dtype=bool)
+        self.cumulative_length = cumulativeLength(self.waypoints)
+        self.n_waypoints_visited = 0
+        self.agroVolumePerSecond = agroVolumePerSecond
 
-    for irow, y in enumerate(np.arange(miny, maxy, step)):
-        row = []
-        for x in np.arange(minx, maxx, step):
-            if poly.contains(Point(x, y)):
-                row.append((x, y))
+    def update(self, dt):
+        self.waypoint_visited[self.n_waypoints_visited] = True
+        self.n_waypoints_visited += 1
 
-        if irow % 2 == 0:
-            row.reverse()
+    def finished(self):
+        return self.n_waypoints_visited >= len(self.waypoints)
 
-        waypoints += row
+    def hasNextWaypoint(self):
+        return not self.finished()
 
-    return waypoints
+    def nextWaypoint(self):
+        return self.waypoints[self.n_waypoints_visited]
 
-class MissionPoly:
+    def getFirstWaypoint(self):
+        return self.waypoints[0]
 
-    def __init__(self, key, type, polygon, step, agroVolumePerSecond=None):
+    def getLastWaypoint(self):
+        return self.waypoints[-1]
+
+    def getTotalLength(self):
+        return float(self.cumulative_length[-1])
+
+
+class MissionPart:
+
+    # Part [begin, end) of a MissionPoly. Waypoints and visited flags are views into parent's arrays,
+    # so no data is copied and the progress of all parts is visible in the parent mission.
+    def __init__(self, key, parent, begin, end):
+        assert 0 <= begin < end <= len(parent.waypoints)
         self.key = key
-        self.type = type
-        self.polygon = polygon
-        self.waypoints = rasterizePolygon(polygon, step)
-        self.waypoint_visited = [False for _ in self.waypoints]
+        self.parent = parent
+        self.begin = begin
+        self.end = end
+        self.type = parent.type
+        self.polygon = parent.polygon
+        self.agroVolumePerSecond = parent.agroVolumePerSecond
+        self.waypoints = parent.waypoints[begin:end]
+        self.waypoint_visited = parent.waypoint_visited[begin:end]
         self.n_waypoints_visited = 0
-        self.agroVolumePerSecond = agroVolumePerSecond
 
     def update(self, dt):
         self.waypoint_visited[self.n_waypoints_visited] = True
@@ -84,12 +122,8 @@ class MissionPoly:
         return self.waypoints[-1]
 
     def getTotalLength(self):
-        length = 0.0
-        for i in range(1, len(self.waypoints)):
-            x0, y0 = self.waypoints[i - 1]
-            x1, y1 = self.waypoints[i]
-            length += distbetween(x0, y0, x1, y1)
-        return length
+        cumulative_length = self.parent.cumulative_length
+        return float(cumulative_length[self.end - 1] - cumulative_length[self.begin])
 
 
 class MissionPath:
@@ -99,6 +133,7 @@ class MissionPath:
         self.key = key
         self.type = type
         self.waypoints = path
+        self.total_length = polylineLength(path)  # path doesn't change
         self.waypoint_visited = [False for _ in self.waypoints]
         self.n_waypoints_visited = 0
 
@@ -122,12 +157,7 @@ class MissionPath:
         return self.waypoints[-1]
 
     def getTotalLength(self):
-        length = 0.0
-        for i in range(1, len(self.waypoints)):
-            x0, y0 = self.waypoints[i - 1]
-            x1, y1 = self.waypoints[i]
-            length += distbetween(x0, y0, x1, y1)
-        return length
+        return self.total_length
 
 
 class MissionPatrol:
@@ -137,6 +167,7 @@ class MissionPatrol:
         self.key = key
         self.type = type
         self.waypoints = path
+        self.total_length = polylineLength(path)  # path doesn't change
         self.waypoint_visited = [False for _ in self.waypoints]
         self.n_waypoints_visited = 0
 
@@ -164,38 +195,115 @@ class MissionPatrol:
         self.n_waypoints_visited = 0
 
     def getTotalLength(self):
-        length = 0.0
-        for i in range(1, len(self.waypoints)):
-            x0, y0 = self.waypoints[i - 1]
-            x1, y1 = self.waypoints[i]
-            length += distbetween(x0, y0, x1, y1)
-        return length
+        return self.total_length
+
+
+def cumulativeLength(waypoints):
+    if len(waypoints) == 0:
+        return np.zeros(1)
+    return np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(waypoints, axis=0), axis=1))])
+
+
+def splitRange(mission, begin, end, time_budget, speed):
+    # splits waypoints [begin, end) of a MissionPoly into ranges each taking no more than time_budget to fly
+    # (but at least one waypoint per range)
+    ranges = []
+    max_length = time_budget * speed
+    cumulative_length = mission.cumulative_length
+    while begin < end:
+        part_end = int(np.searchsorted(cumulative_length, cumulative_length[begin] + max_length, side='right'))
+        part_end = min(end, max(begin + 1, part_end))
+        ranges.append((begin, part_end))
+        begin = part_end
+    return ranges
 
 
 def splitMission(mission, time_budget, speed):
-    result = []
-
-    waypoint_buffer = []
-    mask_buffer = []
-    cur_time = 0
-    for i, wp in enumerate(mission.waypoints):
-        waypoint_buffer.append(wp)
-        mask_buffer.append(mission.waypoint_visited[i])
-        if i > 0:
-            dist = distbetween(wp[0], wp[1], mission.waypoints[i-1][0], mission.waypoints[i-1][1])
-            timespan = dist / speed
-            cur_time += timespan
-
-        if cur_time > time_budget or i + 1 == len(mission.waypoints):
-            mpart = copy.deepcopy(mission)
-            mpart.waypoints = waypoint_buffer
-            mpart.waypoint_visited = mask_buffer
-            waypoint_buffer = []
-            mask_buffer = []
-            cur_time = 0
-            result.append(mpart)
-
-    return result
+    return [MissionPart(mission.key, mission, begin, end)
+            for begin, end in splitRange(mission, 0, len(mission.waypoints), time_budget, speed)]
+
+
+class MissionSplitter:
+
+    # Splits polygon missions into parts by flight time of the slowest drone that can execute them
+    # (per payload type). When fleet changes - parts that were not started yet are lazily re-split, see resplit().
+    def __init__(self, time_budget, drones):
+        self.time_budget = time_budget
+        self.speeds = self.fleetSpeeds(drones)
+        self.parts = {}  # id(parent) -> (parent, [parts])
+        self.stale_types = set()
+        self.next_key = None  # if set - keys for new parts are taken from it, otherwise parent key is used
+
+    @staticmethod
+    def fleetSpeeds(drones):
+        speeds = {}
+        for key, drone in drones.items():
+            for type in drone.payload:
+                speeds[type] = min(speeds.get(type, drone.speed), drone.speed)
+        return speeds
+
+    def newKey(self, parent):
+        if self.next_key is None:
+            return parent.key
+        key = self.next_key
+        self.next_key += 1
+        return key
+
+    def splitRanges(self, mission, begin, end):
+        if mission.type not in self.speeds:
+            # no drone can execute it for now, it will be re-split when such drone appears
+            return [(begin, end)] if begin < end else []
+        return splitRange(mission, begin, end, self.time_budget, self.speeds[mission.type])
+
+    def split(self, mission):
+        parts = [MissionPart(self.newKey(mission), mission, begin, end)
+                 for begin, end in self.splitRanges(mission, 0, len(mission.waypoints))]
+        self.addParts(mission, parts)
+        return parts
+
+    def addParts(self, mission, parts):
+        # registers parts created elsewhere (f.e. by MissionInbox worker), so they will be re-split on fleet change
+        self.parts[id(mission)] = (mission, parts)
+
+    def updateFleet(self, drones):
+        # drones - active fleet (f.e. without charging drones), while no drone of a payload type is active
+        # its missions are not re-split, they will be executed at the previous speed
+        speeds = self.fleetSpeeds(drones)
+        for type, speed in self.speeds.items():
+            speeds.setdefault(type, speed)
+        for type in set(speeds.keys()) | set(self.speeds.keys()):
+            if speeds.get(type) != self.speeds.get(type):
+                self.stale_types.add(type)
+        self.speeds = speeds
+
+    def resplit(self, mission_queue):
+        # re-splits queued and not started parts of missions with stale (changed) fleet speed,
+        # returns newly created parts (they are already added to mission_queue)
+        new_parts = []
+        for parent, parts in self.parts.values():
+            if parent.type not in self.stale_types:
+                continue
+            kept_parts = []
+            ranges = []
+            for part in parts:
+                if part.n_waypoints_visited == 0 and part in mission_queue:
+                    mission_queue.remove(part)
+                    if len(ranges) > 0 and ranges[-1][1] == part.begin:
+                        ranges[-1] = (ranges[-1][0], part.end)
+                    else:
+                        ranges.append((part.begin, part.end))
+                else:
+                    kept_parts.append(part)
+            for begin, end in ranges:
+                for part_begin, part_end in self.splitRanges(parent, begin, end):
+                    part = MissionPart(self.newKey(parent), parent, part_begin, part_end)
+                    mission_queue.append(part)
+                    kept_parts.append(part)
+                    new_parts.append(part)
+            kept_parts.sort(key=lambda part: part.begin)
+            self.parts[id(parent)] = (parent, kept_parts)
+        self.stale_types = set()
+        return new_parts
 
 
 def polySquare(arr):
@@ -203,7 +311,7 @@ def polySquare(arr):
     return [(x0, y0), (x0+w, y0), (x0+w, y0+h), (x0, y0+h)]
 
 
-def load_missions(json_path, step, control_station, world):
+def load_missions(json_path, step, control_station, world, coverage_planner=rasterizePolygon):
     with open(json_path, "r") as file:
         missions_data = json.load(file)
     assert "missions" in missions_data
@@ -212,24 +320,25 @@ def load_missions(json_path, step, control_station, world):
     key = 0
     for mission_data in missions_data["missions"]:
         key += 1
-
-        if "patrolrect" in mission_data or "patrolpolygon" in mission_data:
-            polygon = polySquare(mission_data["patrolrect"]) if "patrolrect" in mission_data else mission_data["patrolpolygon"]
-            polygon.append(polygon[0])
-            mission = MissionPatrol(key, mission_data["type"], polygon)
-            missions.append(mission)
-        elif "destination" in mission_data:
-            destination = mission_data["destination"]
-            # path = world.estimatePath(control_station.x, control_station.y, destination[0], destination[1])
-            mission = MissionPath(key, mission_data["type"], [destination])
-            missions.append(mission)
-        else:
-            polygon = polySquare(mission_data["rect"]) if "rect" in mission_data else mission_data["polygon"]
-            type = mission_data["type"]
-            if type == "agro":
-                mission = MissionPoly(key, type, polygon, step, mission_data["agroVolumePerSecond"])
-            else:
-                mission = MissionPoly(key, type, polygon, step)
-            missions.append(mission)
+        missions.append(parse_mission(mission_data, key, step, world, coverage_planner))
 
     return missions
+
+
+def parse_mission(mission_data, key, step, world, coverage_planner=rasterizePolygon):
+    if "patrolrect" in mission_data or "patrolpolygon" in mission_data:
+        polygon = polySquare(mission_data["patrolrect"]) if "patrolrect" in mission_data else mission_data["patrolpolygon"]
+        polygon.append(polygon[0])
+        mission = MissionPatrol(key, mission_data["type"], polygon)
+    elif "destination" in mission_data:
+        destination = mission_data["destination"]
+        # path = world.estimatePath(control_station.x, control_station.y, destination[0], destination[1])
+        mission = MissionPath(key, mission_data["type"], [destination])
+    else:
+        polygon = polySquare(mission_data["rect"]) if "rect" in mission_data else mission_data["polygon"]
+        type = mission_data["type"]
+        if type == "agro":
+            mission = MissionPoly(key, type, polygon, step, mission_data["agroVolumePerSecond"], world=world, coverage_planner=coverage_planner)
+        else:
+            mission = MissionPoly(key, type, polygon, step, world=world, coverage_planner=coverage_planner)
+    return mission
@@ -0,0 +1,110 @@
+import math
+
+from utils import distbetween
+
+
+class MissionQueue:
+
+    # Missions waiting for a drone. Missions are partitioned by payload type and every partition keeps
+    # a uniform grid over first waypoints, so the scheduler can ask for the k nearest feasible missions
+    # instead of scanning the whole queue. Insertion, removal and membership tests are O(1).
+    def __init__(self, missions=(), cell_size=1000.0):
+        self.cell_size = cell_size
+        self.missions = {}  # id(mission) -> mission, insertion ordered
+        self.by_type = {}  # mission type -> {id(mission): mission}
+        self.grids = {}  # mission type -> {(cx, cy): {id(mission): mission}}
+        self.cells = {}  # id(mission) -> (cx, cy)
+        self.grid_bounds = {}  # mission type -> [mincx, mincy, maxcx, maxcy]
+        self.version = 0  # incremented on every append, so the scheduler can tell that new work has arrived
+        for mission in missions:
+            self.append(mission)
+
+    def __len__(self):
+        return len(self.missions)
+
+    def __iter__(self):
+        return iter(list(self.missions.values()))
+
+    def __contains__(self, mission):
+        return id(mission) in self.missions
+
+    def toCell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def append(self, mission):
+        key = id(mission)
+        assert key not in self.missions, "mission {} is already queued".format(mission.key)
+        cell = self.toCell(*mission.getFirstWaypoint())
+
+        self.missions[key] = mission
+        self.by_type.setdefault(mission.type, {})[key] = mission
+        self.grids.setdefault(mission.type, {}).setdefault(cell, {})[key] = mission
+        self.cells[key] = cell
+        self.version += 1
+
+        bounds = self.grid_bounds.get(mission.type)
+        if bounds is None:
+            self.grid_bounds[mission.type] = [cell[0], cell[1], cell[0], cell[1]]
+        else:
+            bounds[0], bounds[1] = min(bounds[0], cell[0]), min(bounds[1], cell[1])
+            bounds[2], bounds[3] = max(bounds[2], cell[0]), max(bounds[3], cell[1])
+
+    def remove(self, mission):
+        key = id(mission)
+        if key not in self.missions:
+            raise ValueError("mission {} is not queued".format(mission.key))
+        cell = self.cells.pop(key)
+        del self.missions[key]
+        del self.by_type[mission.type][key]
+        grid = self.grids[mission.type]
+        del grid[cell][key]
+        if len(grid[cell]) == 0:
+            del grid[cell]
+
+    def missionsOfType(self, type):
+        return list(self.by_type.get(type, {}).values())
+
+    def nearestFeasible(self, drone, k):
+        # returns up to k queued missions that drone's payload can execute, closest first (by first waypoint)
+        candidates = []
+        for type in drone.payload:
+            candidates += self.nearestOfType(type, drone.x, drone.y, k)
+        candidates.sort(key=lambda item: item[0])
+        return [mission for _, mission in candidates[:k]]
+
+    def nearestOfType(self, type, x, y, k):
+        grid = self.grids.get(type)
+        if not grid or k <= 0:
+            return []
+        mincx, mincy, maxcx, maxcy = self.grid_bounds[type]
+        cx, cy = self.toCell(x, y)
+        max_radius = max(abs(cx - mincx), abs(cx - maxcx), abs(cy - mincy), abs(cy - maxcy))
+
+        found = []
+        radius = 0
+        while radius <= max_radius:
+            for cell in self.ringCells(cx, cy, radius):
+                for mission in grid.get(cell, {}).values():
+                    if not mission.hasNextWaypoint():
+                        continue
+                    found.append((distbetween(x, y, *mission.getFirstWaypoint()), mission))
+            # every mission outside of the visited rings is at least radius * cell_size away
+            if len(found) >= k:
+                found.sort(key=lambda item: item[0])
+                if found[k - 1][0] <= radius * self.cell_size:
+                    break
+            radius += 1
+        found.sort(key=lambda item: item[0])
+        return found[:k]
+
+    @staticmethod
+    def ringCells(cx, cy, radius):
+        if radius == 0:
+            yield cx, cy
+            return
+        for dx in range(-radius, radius + 1):
+            yield cx + dx, cy - radius
+            yield cx + dx, cy + radius
+        for dy in range(-radius + 1, radius):
+            yield cx - radius, cy + dy
+            yield cx + radius, cy + dy
@@ -0,0 +1,356 @@
+import asyncio
+import collections
+import struct
+import threading
+
+import numpy as np
+
+
+# Message-passing model of the swarm radio network.
+# Only the master holds the mission queue, every drone is an asyncio agent with a replica of missions state
+# (mission key -> [status, drone key, visited waypoints]) kept in sync with compact deltas:
+#  - ASSIGN   master gave a mission to a drone,
+#  - RETURN   drone gave a mission back (low battery, patrol loop finished) - sent upstream to the master,
+#  - PROGRESS drone visited more waypoints of its mission - sent upstream, coalesced per tick.
+# Messages travel only along wireless links (not longer than wireless_range) of a BFS tree rooted at the master
+# and are batched per tick: at most one upstream and one downstream message per link.
+# Drones out of master's reach keep their messages in outbox (store-and-forward) and catch up on missed deltas
+# when they are reachable again.
+
+ASSIGN = 1
+RETURN = 2
+PROGRESS = 3
+DELTA_NAMES = {ASSIGN: "assign", RETURN: "return", PROGRESS: "progress"}
+
+UP = 1
+DOWN = 2
+
+HEADER = struct.Struct("<BIH")  # direction, tick, number of deltas
+DELTA = struct.Struct("<IBIiI")  # seq (0 for upstream), kind, mission key, drone key, visited waypoints
+
+
+def encodeBatch(direction, tick, deltas):
+    return HEADER.pack(direction, tick, len(deltas)) + b"".join(DELTA.pack(*delta) for delta in deltas)
+
+
+def decodeBatch(data):
+    direction, tick, n = HEADER.unpack_from(data)
+    deltas = [DELTA.unpack_from(data, HEADER.size + i * DELTA.size) for i in range(n)]
+    return direction, tick, deltas
+
+
+class QueueTransport:
+
+    # in-process delivery through asyncio queues
+    async def open(self, keys):
+        self.queues = {key: asyncio.Queue() for key in keys}
+
+    async def send(self, src, dst, data):
+        await self.queues[dst].put((src, data))
+
+    async def receive(self, key):
+        return await self.queues[key].get()
+
+    async def close(self):
+        pass
+
+
+class SocketTransport:
+
+    # every agent listens to a local TCP port, a stand-in for the radio
+    FRAME = struct.Struct("<iI")  # source drone key, payload length
+
+    async def open(self, keys):
+        self.queues = {key: asyncio.Queue() for key in keys}
+        self.servers = {}
+        self.ports = {}
+        self.writers = {}  # (src, dst) -> StreamWriter
+        for key in keys:
+            server = await asyncio.start_server(lambda reader, writer, key=key: self.serve(key, reader, writer), "127.0.0.1", 0)
+            self.servers[key] = server
+            self.ports[key] = server.sockets[0].getsockname()[1]
+
+    async def serve(self, key, reader, writer):
+        try:
+            while True:
+                src, length = self.FRAME.unpack(await reader.readexactly(self.FRAME.size))
+                await self.queues[key].put((str(src), await reader.readexactly(length)))
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    async def send(self, src, dst, data):
+        writer = self.writers.get((src, dst))
+        if writer is None:
+            _, writer = await asyncio.open_connection("127.0.0.1", self.ports[dst])
+            self.writers[(src, dst)] = writer
+        writer.write(self.FRAME.pack(int(src), len(data)) + data)
+        await writer.drain()
+
+    async def receive(self, key):
+        return await self.queues[key].get()
+
+    async def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        for server in self.servers.values():
+            server.close()
+            await server.wait_closed()
+
+
+TRANSPORTS = {"queue": QueueTransport, "socket": SocketTransport}
+
+
+class MissionListProxy:
+
+    # Drone.mission_list of a drone in the message-passing model: returned missions are sent to the master,
+    # all other operations are allowed only on the master, which holds the real mission queue
+    def __init__(self, network, drone):
+        self.network = network
+        self.drone = drone
+
+    def append(self, mission):
+        self.network.sendReturn(self.drone, mission)
+
+    def __getattr__(self, name):
+        assert self.drone.is_master, "only master holds the mission queue"
+        return getattr(self.network.mission_queue, name)
+
+
+class DroneAgent:
+
+    def __init__(self, network, drone):
+        self.network = network
+        self.drone = drone
+        self.key = drone.key
+        self.seq = 0  # last applied master delta
+        self.missions = {}  # replica: mission key -> [kind of the last delta, drone key, visited waypoints]
+        self.outbox = collections.OrderedDict()  # (kind, mission key) -> delta to the master, waits until master is reachable
+        self.reported_progress = None  # (mission key, visited waypoints)
+        self.upstream = []  # deltas of this tick from this drone and its subtree
+        self.children_pending = 0
+
+    def collectProgress(self):
+        mission = self.drone.targetMission
+        if mission is None:
+            return
+        progress = (mission.key, mission.n_waypoints_visited)
+        if progress != self.reported_progress:
+            self.reported_progress = progress
+            self.outbox[(PROGRESS, mission.key)] = (0, PROGRESS, mission.key, int(self.key), mission.n_waypoints_visited)
+
+    def apply(self, delta):
+        seq, kind, mission_key, drone_key, visited = delta
+        self.missions[mission_key] = [kind, drone_key, visited]
+        self.seq = seq
+
+    async def run(self):
+        while True:
+            src, data = await self.network.transport.receive(self.key)
+            direction, tick, deltas = decodeBatch(data)
+            if direction == UP:
+                self.upstream += deltas
+                self.children_pending -= 1
+                if self.children_pending == 0 and not self.drone.is_master:
+                    await self.sendUp()
+            else:
+                for delta in deltas:
+                    if delta[0] > self.seq:
+                        self.apply(delta)
+                await self.sendDown(deltas)
+            self.network.handled()
+
+    async def sendUp(self):
+        deltas = self.upstream + list(self.outbox.values())
+        self.upstream = []
+        self.outbox.clear()
+        await self.network.send(self.key, self.network.parents[self.key], encodeBatch(UP, self.network.ticks, deltas))
+
+    async def sendDown(self, deltas):
+        for child in self.network.children[self.key]:
+            from_seq = self.network.subtree_seq[child]
+            child_deltas = [delta for delta in deltas if delta[0] > from_seq]
+            if len(child_deltas) > 0:
+                await self.network.send(self.key, child, encodeBatch(DOWN, self.network.ticks, child_deltas))
+
+
+class SwarmNetwork:
+
+    def __init__(self, world, drones, mission_queue, transport="queue"):
+        self.world = world
+        self.drones = drones
+        self.mission_queue = mission_queue
+        self.master_key = world.getMasterDrone().key
+        self.transport = TRANSPORTS[transport]()
+        self.agents = {key: DroneAgent(self, drone) for key, drone in drones.items()}
+        self.missions = {}  # mission key -> mission, for all missions master has given away
+        self.log = []  # master deltas not yet received by all drones
+        self.seq = 0
+        self.lock = threading.Lock()  # ShardedScheduler may assign missions from several threads
+
+        self.reachable_keys = None  # drones in master's reach when routes were built last time
+        self.exchanged_seq = 0  # last master delta when the exchange was done last time
+        self.parents = {}
+        self.children = {}
+        self.subtree_seq = {}
+        self.in_flight = 0
+        self.idle = None
+
+        self.ticks = 0
+        self.skipped = 0
+        self.link_messages = collections.Counter()  # (src, dst) -> messages
+        self.link_bytes = collections.Counter()  # (src, dst) -> bytes of payload
+        self.deltas_sent = collections.Counter()  # delta name -> deltas published by the master
+
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.start())
+
+    async def start(self):
+        await self.transport.open(sorted(self.agents.keys()))
+        self.idle = asyncio.Event()
+        self.tasks = [asyncio.ensure_future(agent.run()) for agent in self.agents.values()]
+
+    def shutdown(self):
+        async def stop():
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.transport.close()
+        self.loop.run_until_complete(stop())
+        self.loop.close()
+
+    def attach(self):
+        for key, drone in self.drones.items():
+            drone.setMissionList(self.mission_queue if drone.is_master else MissionListProxy(self, drone))
+            drone.setNetwork(self)
+
+    def publish(self, kind, mission, drone_key, visited):
+        with self.lock:
+            self.seq += 1
+            delta = (self.seq, kind, mission.key, int(drone_key), visited)
+            self.log.append(delta)
+            self.agents[self.master_key].apply(delta)
+            self.deltas_sent[DELTA_NAMES[kind]] += 1
+
+    def publishAssign(self, mission, drone):
+        self.missions[mission.key] = mission
+        self.publish(ASSIGN, mission, drone.key, mission.n_waypoints_visited)
+
+    def sendReturn(self, drone, mission):
+        if drone.is_master:
+            self.receiveReturn(drone.key, mission)
+        else:
+            agent = self.agents[drone.key]
+            agent.outbox.pop((PROGRESS, mission.key), None)
+            agent.outbox[(RETURN, mission.key)] = (0, RETURN, mission.key, int(drone.key), mission.n_waypoints_visited)
+
+    def receiveReturn(self, drone_key, mission):
+        self.mission_queue.append(mission)
+        self.publish(RETURN, mission, drone_key, mission.n_waypoints_visited)
+
+    async def send(self, src, dst, data):
+        self.link_messages[(src, dst)] += 1
+        self.link_bytes[(src, dst)] += len(data)
+        self.in_flight += 1
+        self.idle.clear()
+        await self.transport.send(src, dst, data)
+
+    def handled(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.idle.set()
+
+    def buildRoutes(self):
+        # BFS tree over wireless links from the master, only reachable drones are in it
+        master_drone = self.drones[self.master_key]
+        reachable = self.world.getWirelessReachableDrones(master_drone)
+        keys = sorted(reachable.keys())
+        if self.reachable_keys is not None and master_drone.scheduler is not None:
+            changed_keys = self.reachable_keys.symmetric_difference(keys)
+            if len(changed_keys) > 0:
+                master_drone.scheduler.notifyConnectivityChanged(changed_keys)
+        self.reachable_keys = frozenset(keys)
+        xy = np.array([(reachable[key].x, reachable[key].y) for key in keys], np.float64)
+        distances = np.hypot(xy[:, None, 0] - xy[None, :, 0], xy[:, None, 1] - xy[None, :, 1])
+        linked = distances <= self.world.wireless_range
+        index = {key: i for i, key in enumerate(keys)}
+        self.parents = {self.master_key: None}
+        self.children = {key: [] for key in keys}
+        order = [self.master_key]
+        for key in order:
+            for i in np.nonzero(linked[index[key]])[0]:
+                child = keys[i]
+                if child not in self.parents:
+                    self.parents[child] = key
+                    self.children[key].append(child)
+                    order.append(child)
+        return order
+
+    def hasPendingDeltas(self):
+        if any(len(agent.outbox) > 0 for agent in self.agents.values()) or self.seq > self.exchanged_seq:
+            return True
+        # the log still has deltas only for drones out of master's reach, retry when the scheduler's cached reachability
+        # (it is refreshed whenever the scheduler needs it) sees one of them
+        lagging = {key for key, agent in self.agents.items() if agent.seq < self.seq}
+        scheduler = self.drones[self.master_key].scheduler
+        reachable_keys = scheduler.reachable_keys if scheduler is not None else None
+        return len(lagging) > 0 and (reachable_keys is None or not lagging.isdisjoint(reachable_keys))
+
+    async def exchange(self):
+        for agent in self.agents.values():
+            agent.collectProgress()
+        if not self.hasPendingDeltas():
+            # nothing to send: no routes are built, connectivity changes are noticed by the next exchange
+            self.skipped += 1
+            return
+        order = self.buildRoutes()
+
+        # upstream: every drone waits for batches of children with something to send, then sends one batch to its parent
+        has_upstream = {}
+        for key in reversed(order):
+            agent = self.agents[key]
+            agent.children_pending = sum(1 for child in self.children[key] if has_upstream[child])
+            has_upstream[key] = len(agent.outbox) > 0 or agent.children_pending > 0
+        self.idle.set()
+        for key in order:
+            if key != self.master_key and has_upstream[key] and self.agents[key].children_pending == 0:
+                await self.agents[key].sendUp()
+        await self.idle.wait()
+
+        master = self.agents[self.master_key]
+        upstream = sorted(master.upstream + list(master.outbox.values()), key=lambda delta: (delta[3], delta[1], delta[2]))
+        master.upstream = []
+        master.outbox.clear()
+        for _, kind, mission_key, drone_key, visited in upstream:
+            mission = self.missions[mission_key]
+            if kind == RETURN:
+                self.receiveReturn(str(drone_key), mission)
+            else:
+                self.publish(PROGRESS, mission, drone_key, visited)
+
+        # downstream: deltas which are missing in some drone of child's subtree
+        for key in reversed(order):
+            self.subtree_seq[key] = min([self.agents[key].seq] + [self.subtree_seq[child] for child in self.children[key]])
+        if len(self.log) > 0:
+            await master.sendDown([delta for delta in self.log if delta[0] > self.subtree_seq[self.master_key]])
+            await self.idle.wait()
+
+        acked = min(agent.seq for agent in self.agents.values())
+        self.log = [delta for delta in self.log if delta[0] > acked]
+        self.exchanged_seq = self.seq
+
+    def tick(self):
+        self.loop.run_until_complete(self.exchange())
+        self.ticks += 1
+
+    def stats(self):
+        return {"ticks": self.ticks, "skipped": self.skipped, "links_used": len(self.link_messages),
+                "messages": sum(self.link_messages.values()), "bytes": sum(self.link_bytes.values()),
+                "deltas_assign": self.deltas_sent["assign"], "deltas_return": self.deltas_sent["return"],
+                "deltas_progress": self.deltas_sent["progress"], "log_size": len(self.log),
+                "outbox": sum(len(agent.outbox) for agent in self.agents.values()),
+                "max_replica_lag": max(self.seq - agent.seq for agent in self.agents.values())}
+
+    def linkStats(self):
+        return {"{}->{}".format(src, dst): {"messages": self.link_messages[(src, dst)], "bytes": self.link_bytes[(src, dst)],
+                                            "bytes_per_tick": self.link_bytes[(src, dst)] / max(1, self.ticks)}
+                for src, dst in sorted(self.link_messages.keys())}
@@ -0,0 +1,244 @@
+import concurrent.futures
+
+from utils import distbetween
+
+
+# Rolling-horizon look-ahead planner. Heavy planning runs in a worker process on a compact snapshot of the swarm,
+# master applies the latest completed plan without blocking the simulation tick.
+# Until the first plan arrives (or when the latest plan is expired) greedy EventScheduler is used as a fallback.
+
+
+class Plan:
+
+    def __init__(self, created_at, valid_until, assignments, planning_time):
+        self.created_at = created_at  # simulation time of the snapshot
+        self.valid_until = valid_until  # simulation time after which the plan should not be applied
+        self.assignments = assignments  # drone key -> [(mission key, charge station key or None), ...]
+        self.planning_time = planning_time  # wall time spent in the worker, in seconds
+
+
+def snapshotSwarm(drones, mission_queue, charge_stations, charge_power, time):
+    drones_snapshot = []
+    for key in sorted(drones.keys()):
+        drone = drones[key]
+        busy_time, x, y, lifetime = 0.0, drone.x, drone.y, drone.lifetime_left
+        if drone.targetMission is not None:
+            # drone will be available only after its current mission part
+            busy_time = drone.timeTo(*drone.targetMission.getFirstWaypoint()) + drone.targetMission.getTotalLength() / drone.speed
+            x, y = drone.targetMission.getLastWaypoint()
+            lifetime -= busy_time
+        elif drone.state in {"flyToCharge", "onCharge"}:
+            if drone.targetX is not None:
+                busy_time = drone.timeTo(drone.targetX, drone.targetY)
+                x, y = drone.targetX, drone.targetY
+            busy_time += (drone.max_lifetime - drone.lifetime_left + busy_time) / drone.charge_power
+            lifetime = drone.max_lifetime
+        drones_snapshot.append((key, float(x), float(y), drone.speed, float(busy_time), lifetime, drone.max_lifetime,
+                                tuple(drone.payload), drone.payloadAgroVolumeLeft, drone.payloadAgroVolume))
+
+    missions_snapshot = []
+    for mission in mission_queue:
+        if not mission.hasNextWaypoint():
+            continue
+        missions_snapshot.append((mission.key, mission.type, tuple(map(float, mission.getFirstWaypoint())),
+                                  tuple(map(float, mission.getLastWaypoint())), mission.getTotalLength(),
+                                  getattr(mission, "agroVolumePerSecond", None) or 0.0))
+
+    stations_snapshot = [(key, station.x, station.y) for key, station in sorted(charge_stations.items())]
+    return time, drones_snapshot, missions_snapshot, stations_snapshot, charge_power
+
+
+def closestStation(x, y, stations):
+    best = None
+    for key, sx, sy in stations:
+        distance = distbetween(x, y, sx, sy)
+        if best is None or distance < best[1]:
+            best = (key, distance, sx, sy)
+    return best
+
+
+def planAssignments(snapshot, horizon):
+    # Executed in the worker process. Greedily builds per-drone sequences of mission parts over the planning horizon:
+    # on each step the (drone, mission) pair with the earliest completion time is chosen,
+    # where a drone is allowed to fly to the closest charge station first if its battery is not enough.
+    import time as timer
+    started = timer.time()
+
+    time, drones, missions, stations, charge_power = snapshot
+    INF = 1e12
+
+    # mutable drone state: [available_at, x, y, lifetime_left, agro_left]
+    states = {}
+    for key, x, y, speed, busy_time, lifetime_left, max_lifetime, payload, agro_left, agro_volume in drones:
+        states[key] = [busy_time, x, y, lifetime_left, agro_left]
+    drones_info = {drone[0]: drone for drone in drones}
+
+    assignments = {key: [] for key in drones_info}
+    unassigned = {mission[0]: mission for mission in missions}
+    while len(unassigned) > 0:
+        best, best_finish = None, INF
+        for key, (available_at, x, y, lifetime_left, agro_left) in states.items():
+            if available_at > horizon:
+                continue
+            _, _, _, speed, _, _, max_lifetime, payload, _, agro_volume = drones_info[key]
+            for mission_key, type, first, last, length, agro_per_second in unassigned.values():
+                if type not in payload:
+                    continue
+                time_to_execute = length / speed
+                _, station_distance, _, _ = closestStation(*last, stations)
+                time_after = time_to_execute + station_distance / speed
+                agro_needed = time_to_execute * agro_per_second if type == "agro" else 0.0
+
+                time_to_start = distbetween(x, y, *first) / speed
+                if time_to_start + time_after <= lifetime_left and agro_needed <= agro_left:
+                    finish = available_at + time_to_start + time_to_execute
+                    state_after = [finish, last[0], last[1], lifetime_left - time_to_start - time_to_execute, agro_left - agro_needed]
+                    station = None
+                else:
+                    # charge trip before the mission
+                    station, distance_to_station, sx, sy = closestStation(x, y, stations)
+                    time_to_station = distance_to_station / speed
+                    if time_to_station > lifetime_left:
+                        continue
+                    time_to_start = distbetween(sx, sy, *first) / speed
+                    if time_to_start + time_after > max_lifetime or agro_needed > agro_volume:
+                        continue
+                    charge_time = (max_lifetime - (lifetime_left - time_to_station)) / charge_power
+                    finish = available_at + time_to_station + charge_time + time_to_start + time_to_execute
+                    state_after = [finish, last[0], last[1], max_lifetime - time_to_start - time_to_execute, agro_volume - agro_needed]
+                if finish < best_finish:
+                    best, best_finish = (key, mission_key, station, state_after), finish
+        if best is None:
+            break
+
+        key, mission_key, station, state_after = best
+        del unassigned[mission_key]
+        states[key] = state_after
+        assignments[key].append((mission_key, station))
+
+    return Plan(time, time + horizon, assignments, timer.time() - started)
+
+
+class PlannerService:
+
+    def __init__(self, world, mission_queue, charge_stations, scheduler, horizon=3600.0, replan_period=60.0):
+        self.world = world
+        self.mission_queue = mission_queue
+        self.charge_stations = charge_stations
+        self.scheduler = scheduler  # greedy fallback
+        self.horizon = horizon  # seconds of simulation time
+        self.replan_period = replan_period  # seconds of simulation time
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        self.future = None
+        self.plan = None
+        self.planned = {}  # drone key -> remaining [(mission key, station key or None), ...] of the latest plan
+        # mission key -> (drone key, mission) taken out of the queue while the drone is on its planned charge trip,
+        # so that the greedy scheduler can't give the mission to another drone
+        self.reserved = {}
+        self.time = 0.0
+        self.last_submit_time = None
+
+        self.plans_received = 0
+        self.plan_assignments_applied = 0
+        self.plan_assignments_rejected = 0
+        self.fallback_ticks = 0
+        self.reservations_released = 0
+
+    def stats(self):
+        return {"plans_received": self.plans_received, "plan_assignments_applied": self.plan_assignments_applied,
+                "plan_assignments_rejected": self.plan_assignments_rejected, "fallback_ticks": self.fallback_ticks,
+                "reserved": len(self.reserved), "reservations_released": self.reservations_released,
+                "last_planning_time": self.plan.planning_time if self.plan is not None else None}
+
+    def shutdown(self):
+        if self.future is not None:
+            self.future.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def release(self, mission_key):
+        _, mission = self.reserved.pop(mission_key)
+        self.mission_queue.append(mission)
+        self.reservations_released += 1
+
+    def tick(self, dt):
+        self.time += dt
+
+        if self.future is not None and self.future.done():
+            plan = self.future.result()
+            self.future = None
+            if self.plan is None or plan.created_at >= self.plan.created_at:
+                self.plan = plan
+                self.planned = {key: list(entries) for key, entries in plan.assignments.items()}
+                # reserved missions were not in the snapshot, they stay the first ones of their drones
+                for mission_key, (drone_key, _) in sorted(self.reserved.items()):
+                    self.planned.setdefault(drone_key, []).insert(0, (mission_key, None))
+                self.plans_received += 1
+
+        for mission_key, (drone_key, mission) in list(self.reserved.items()):
+            if self.world.drones[drone_key].targetMission not in (None, mission):
+                # the drone got another mission (f.e. from the greedy scheduler while it was out of master's reach)
+                self.release(mission_key)
+
+        if self.future is None and (self.last_submit_time is None or self.time - self.last_submit_time >= self.replan_period):
+            snapshot = snapshotSwarm(self.world.drones, self.mission_queue, self.charge_stations, self.world.charge_power, self.time)
+            self.future = self.executor.submit(planAssignments, snapshot, self.horizon)
+            self.last_submit_time = self.time
+
+        if self.plan is None or self.time > self.plan.valid_until:
+            for mission_key in sorted(self.reserved.keys()):
+                self.release(mission_key)
+            self.fallback_ticks += 1
+            self.scheduler.tick()
+            return
+
+        waiting_drones = [drone for drone in self.scheduler.waiting_drones.values()
+                          if drone.needTask() and len(self.planned.get(drone.key, [])) > 0]
+        if len(waiting_drones) == 0:
+            # nothing planned for idle drones - keep the greedy scheduler working for them
+            self.scheduler.tick()
+            return
+
+        master_drone = self.world.getMasterDrone()
+        available_drones = self.world.getWirelessReachableDrones(master_drone)
+        missions_by_key = {mission.key: mission for mission in self.mission_queue}
+        for drone in waiting_drones:
+            if drone.key not in available_drones:
+                continue
+            entries = self.planned[drone.key]
+            while len(entries) > 0:
+                mission_key, station_key = entries.pop(0)
+                mission = missions_by_key.get(mission_key)
+                is_reserved = mission is None and self.reserved.get(mission_key, (None, None))[0] == drone.key
+                if is_reserved:
+                    mission = self.reserved[mission_key][1]
+                if mission is None or not mission.hasNextWaypoint():
+                    if is_reserved:
+                        self.release(mission_key)
+                    self.plan_assignments_rejected += 1
+                    continue
+                if station_key is not None:
+                    # first top up the battery, the mission is reserved for the drone until it is charged
+                    entries.insert(0, (mission_key, None))
+                    if not is_reserved:
+                        self.mission_queue.remove(mission)
+                        del missions_by_key[mission_key]
+                        self.reserved[mission_key] = (drone.key, mission)
+                    drone.flying = True
+                    drone.flyToStation(self.charge_stations[station_key], self.world)
+                    self.plan_assignments_applied += 1
+                    break
+                if not drone.canExecute(mission, self.charge_stations):
+                    if is_reserved:
+                        self.release(mission_key)
+                    self.plan_assignments_rejected += 1
+                    continue
+                drone.addTask(mission, self.world)
+                if is_reserved:
+                    del self.reserved[mission_key]
+                else:
+                    self.mission_queue.remove(mission)
+                    del missions_by_key[mission_key]
+                self.plan_assignments_applied += 1
+                break
+        self.scheduler.tick()
@@ -0,0 +1,284 @@
+import concurrent.futures
+
+import numpy as np
+
+from eventlog import events, ComponentMerged
+from geometry import pairwiseDistances
+from mission_queue import MissionQueue
+
+
+class EventScheduler:
+
+    # Runs master's tryToScheduleTasks only when something relevant happened since the last planning:
+    # a drone entered "wait", a mission was (re)added to the queue (returned on low battery, patrol reset, new mission)
+    # or wireless connectivity changed while some idle drone was out of master's reach.
+    # On all other ticks scheduling is skipped, see runs/skips counters.
+    def __init__(self, world, mission_queue, charge_stations):
+        self.world = world
+        self.mission_queue = mission_queue
+        self.charge_stations = charge_stations
+
+        self.new_idle_drones = {}  # drones that entered "wait" since the last planning
+        self.waiting_drones = {}  # idle drones that still have no task
+        self.missions_version = None
+        self.reachable_keys = None
+
+        self.runs = 0
+        self.skips = 0
+        self.reachability_checks = 0
+
+    def notifyDroneIdle(self, drone):
+        self.new_idle_drones[drone.key] = drone
+        self.waiting_drones[drone.key] = drone
+
+    def notifyConnectivityChanged(self, changed_keys=None):
+        # called by SwarmNetwork when drones entered or left master's reach, without it changes are noticed only
+        # while some waiting drone is out of master's reach; only waiting drones matter, others get no tasks anyway
+        if changed_keys is None or any(key in self.waiting_drones for key in changed_keys):
+            self.reachable_keys = None
+
+    def stats(self):
+        return {"runs": self.runs, "skips": self.skips, "reachability_checks": self.reachability_checks}
+
+    def pruneWaitingDrones(self):
+        # forgets drones which got a task or left "wait", returns whether missions changed since the last planning
+        for key, drone in list(self.waiting_drones.items()):
+            if not drone.needTask():
+                del self.waiting_drones[key]
+                self.new_idle_drones.pop(key, None)
+        return self.missions_version != self.mission_queue.version
+
+    def affectedDrones(self, missions_changed, connectivity_changed):
+        # all waiting drones may get a task after missions or connectivity changed, otherwise only the new idle ones
+        return self.waiting_drones if missions_changed or connectivity_changed else self.new_idle_drones
+
+    def startRun(self):
+        self.missions_version = self.mission_queue.version
+        self.new_idle_drones = {}
+        self.runs += 1
+
+    def tick(self):
+        missions_changed = self.pruneWaitingDrones()
+        has_unreachable_waiting = self.reachable_keys is None or \
+            any(key not in self.reachable_keys for key in self.waiting_drones)
+        if len(self.waiting_drones) == 0 or (len(self.new_idle_drones) == 0 and not missions_changed and not has_unreachable_waiting):
+            self.skips += 1
+            return
+
+        master_drone = self.world.getMasterDrone()
+        self.reachability_checks += 1
+        available_drones = self.world.getWirelessReachableDrones(master_drone)
+        reachable_keys = frozenset(available_drones.keys())
+        connectivity_changed = reachable_keys != self.reachable_keys
+        self.reachable_keys = reachable_keys
+
+        affected_drones = self.affectedDrones(missions_changed, connectivity_changed)
+        affected_drones = [drone for key, drone in affected_drones.items() if key in reachable_keys]
+        if len(affected_drones) == 0:
+            self.skips += 1
+            return
+
+        self.startRun()
+        master_drone.tryToScheduleTasks(available_drones, self.charge_stations, self.world, affected_drones)
+
+
+class ShardedScheduler(EventScheduler):
+
+    # Schedules every connected component of the wireless network instead of master's component only.
+    # Each component elects a local coordinator (master if it is in the component, otherwise the drone with the smallest key),
+    # which runs tryToScheduleTasks for drones of its component against its partition of the mission queue.
+    # Partitions are leases: a mission closer to a component without master than to any other component (counting only
+    # drones with a suitable payload which can reach it, execute it and reach a station on a full battery) is moved
+    # from master's queue to the partition, so two coordinators never claim one mission.
+    # A lease expires after lease_ticks ticks without a claim, or as soon as no drone of the component can take the mission
+    # (f.e. the component split), the mission goes back to master's queue and is not leased to that coordinator again
+    # until connectivity changes.
+    # When components merge the partition goes to the coordinator of the merged component: back to master's queue
+    # (missions not claimed yet are returned, local claims are reconciled with master) or into another partition.
+    # Components share no drones and no missions, so they are scheduled in a thread pool; threads and not processes because
+    # drones and missions are updated in place. Which drone gets which mission does not depend on the number of workers,
+    # only the order of events of different components does. Path planning and metrics are shared by threads,
+    # see World.paths_lock and Metrics.lock.
+    def __init__(self, world, mission_queue, charge_stations, workers=0, lease_ticks=600):
+        super().__init__(world, mission_queue, charge_stations)
+        self.workers = workers  # 0 - components are scheduled in the calling thread
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.lease_ticks = lease_ticks
+        self.ticks = 0
+
+        self.components = None  # frozenset of components (frozensets of drone keys) of the last planning
+        self.partitions = {}  # coordinator key -> MissionQueue with missions leased to its component
+        self.claims = {}  # coordinator key -> [(mission key, drone key), ...] not yet reconciled with master
+        self.leased_at = {}  # mission key -> tick when it was leased
+        self.expired = {}  # mission key -> coordinator key its lease expired from, until connectivity changes
+
+        self.component_runs = 0
+        self.leased = 0
+        self.returned = 0
+        self.claimed = 0
+        self.reconciled = 0
+        self.merges = 0
+        self.expirations = 0
+
+    def notifyConnectivityChanged(self, changed_keys=None):
+        super().notifyConnectivityChanged(changed_keys)
+        if self.reachable_keys is None:
+            self.components = None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"workers": self.workers, "components": len(self.components) if self.components is not None else 0,
+                      "component_runs": self.component_runs, "partitions": len(self.partitions),
+                      "leased_missions": sum(len(partition) for partition in self.partitions.values()),
+                      "leased": self.leased, "returned": self.returned, "claimed": self.claimed,
+                      "reconciled": self.reconciled, "merges": self.merges, "expirations": self.expirations})
+        return stats
+
+    def findComponents(self):
+        # [(coordinator, {key: drone}), ...], master's component first, then by the smallest key
+        master_drone = self.world.getMasterDrone()
+        self.reachability_checks += 1
+        components = []
+        for component in self.world.getWirelessComponents():
+            if master_drone.key in component:
+                components.insert(0, (master_drone, component))
+            else:
+                components.append((component[min(component.keys())], component))
+        return components
+
+    def reconcile(self, components):
+        coordinator_of = {}
+        for coordinator, component in components:
+            for key in component:
+                coordinator_of[key] = coordinator
+        for old_key in sorted(self.partitions.keys()):
+            coordinator = coordinator_of[old_key]
+            if coordinator.key == old_key:
+                continue
+            self.merges += 1
+            partition = self.partitions.pop(old_key)
+            claims = self.claims.pop(old_key, [])
+            if coordinator.is_master:
+                for mission in partition:
+                    self.returnLease(mission)
+                self.returned += len(partition)
+                self.reconciled += len(claims)
+                events.emit(ComponentMerged, old_key, len(partition), len(claims))
+            else:
+                target = self.partitions.setdefault(coordinator.key, MissionQueue())
+                for mission in partition:
+                    target.append(mission)
+                self.claims.setdefault(coordinator.key, []).extend(claims)
+
+    def distances(self, missions, drones):
+        # (missions, drones) distances to the first waypoints, inf where the drone can't take the mission even on a full battery
+        xs = [mission.getFirstWaypoint()[0] for mission in missions]
+        ys = [mission.getFirstWaypoint()[1] for mission in missions]
+        distances = pairwiseDistances(xs, ys, [drone.x for drone in drones], [drone.y for drone in drones])
+        stations_x = [station.x for station in self.charge_stations.values()]
+        stations_y = [station.y for station in self.charge_stations.values()]
+        lengths = np.array([mission.getTotalLength() for mission in missions])
+        to_charge = pairwiseDistances([mission.getLastWaypoint()[0] for mission in missions],
+                                      [mission.getLastWaypoint()[1] for mission in missions], stations_x, stations_y).min(axis=1)
+        speeds = np.array([drone.speed for drone in drones])
+        max_lifetimes = np.array([drone.max_lifetime for drone in drones])
+        total_times = (distances + lengths[:, None] + to_charge[:, None]) / speeds[None, :]
+        has_payload = np.array([[mission.type in drone.payload for drone in drones] for mission in missions])
+        return np.where(has_payload & (total_times <= max_lifetimes[None, :]), distances, np.inf)
+
+    def returnLease(self, mission):
+        self.leased_at.pop(mission.key, None)
+        self.mission_queue.append(mission)
+
+    def expireLeases(self, components):
+        # returns missions not claimed in time or which no drone of the component can take anymore
+        component_of = {coordinator.key: component for coordinator, component in components}
+        for coordinator_key, partition in sorted(self.partitions.items()):
+            missions = [mission for mission in partition if mission.hasNextWaypoint()]
+            if len(missions) == 0:
+                continue
+            can_take = np.isfinite(self.distances(missions, list(component_of[coordinator_key].values()))).any(axis=1)
+            for mission, is_feasible in zip(missions, can_take):
+                if is_feasible and self.ticks - self.leased_at.get(mission.key, self.ticks) < self.lease_ticks:
+                    continue
+                partition.remove(mission)
+                self.returnLease(mission)
+                self.expired[mission.key] = coordinator_key
+                self.expirations += 1
+
+    def lease(self, components, leasing_keys):
+        missions = [mission for mission in self.mission_queue if mission.hasNextWaypoint()]
+        if len(missions) == 0 or len(leasing_keys) == 0:
+            return
+        best_distances = np.full(len(missions), np.inf)
+        owners = np.full(len(missions), -1)
+        for index, (coordinator, component) in enumerate(components):
+            distances = self.distances(missions, list(component.values())).min(axis=1)
+            closer = distances < best_distances
+            best_distances[closer] = distances[closer]
+            owners[closer] = index
+        for mission, owner in zip(missions, owners):
+            if owner < 0:
+                continue
+            coordinator = components[owner][0]
+            if coordinator.key in leasing_keys and self.expired.get(mission.key) != coordinator.key:
+                self.mission_queue.remove(mission)
+                self.partitions.setdefault(coordinator.key, MissionQueue()).append(mission)
+                self.leased_at[mission.key] = self.ticks
+                self.leased += 1
+
+    def scheduleComponent(self, coordinator, component, idle_drones):
+        mission_list = None if coordinator.is_master else self.partitions.get(coordinator.key)
+        if mission_list is None and not coordinator.is_master:
+            return []
+        coordinator.tryToScheduleTasks(component, self.charge_stations, self.world, idle_drones, mission_list)
+        if coordinator.is_master:
+            return []
+        return [(drone.targetMission.key, drone.key) for drone in idle_drones if drone.targetMission is not None]
+
+    def tick(self):
+        self.ticks += 1
+        missions_changed = self.pruneWaitingDrones()
+        # with more than one component connectivity can change on any tick
+        if len(self.waiting_drones) == 0 or (len(self.new_idle_drones) == 0 and not missions_changed and
+                                             self.components is not None and len(self.components) == 1):
+            self.skips += 1
+            return
+
+        components = self.findComponents()
+        keys = frozenset(frozenset(component.keys()) for _, component in components)
+        connectivity_changed = keys != self.components
+        self.components = keys
+        if connectivity_changed:
+            self.expired = {}
+        self.reconcile(components)
+        self.expireLeases(components)
+
+        affected_drones = self.affectedDrones(missions_changed, connectivity_changed)
+        jobs = []
+        for coordinator, component in components:
+            idle_drones = [drone for key, drone in affected_drones.items() if key in component]
+            if len(idle_drones) > 0:
+                jobs.append((coordinator, component, idle_drones))
+        if len(jobs) == 0:
+            self.skips += 1
+            return
+
+        self.lease(components, {coordinator.key for coordinator, _, _ in jobs if not coordinator.is_master})
+        self.startRun()
+        self.component_runs += len(jobs)
+        if self.executor is None:
+            results = [self.scheduleComponent(*job) for job in jobs]
+        else:
+            futures = [self.executor.submit(self.scheduleComponent, *job) for job in jobs]
+            results = [future.result() for future in futures]
+        for (coordinator, _, _), claims in zip(jobs, results):
+            for mission_key, _ in claims:
+                self.leased_at.pop(mission_key, None)
+            if len(claims) > 0:
+                self.claims.setdefault(coordinator.key, []).extend(claims)
+                self.claimed += len(claims)
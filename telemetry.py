@@ -0,0 +1,165 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from utils import dist
+
+
+# Per-tick telemetry recording and replay.
+# A recording is a directory with meta.json and chunk_XXXXX.npz files. Each chunk holds preallocated columns:
+# time[ticks], and per drone (in sorted keys order) x, y, state, lifetime_left, target_x, target_y (NaN if no target),
+# mission (key of target mission or -1) and mission_progress (visited waypoints / waypoints of target mission).
+
+STATES = ["wait", "flyToMission", "onMission", "flyToCharge", "onCharge"]
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+COLUMNS = {
+    "x": np.float64,
+    "y": np.float64,
+    "state": np.int8,
+    "lifetime_left": np.float32,
+    "target_x": np.float64,
+    "target_y": np.float64,
+    "mission": np.int32,
+    "mission_progress": np.float32,
+}
+
+
+class TelemetryRecorder:
+
+    def __init__(self, path, drones, world_json_path, stations_json_path, chunk_size=4096):
+        self.path = path
+        self.keys = sorted(drones.keys())
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        for old_chunk in glob.glob(os.path.join(path, "chunk_*.npz")):
+            os.remove(old_chunk)
+        meta = {"drones": self.keys, "masters": [drones[key].is_master for key in self.keys],
+                "max_lifetimes": [drones[key].max_lifetime for key in self.keys], "states": STATES,
+                "world": world_json_path, "stations": stations_json_path, "chunk_size": chunk_size}
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump(meta, file, indent=2)
+
+        n = len(self.keys)
+        self.time = np.zeros(chunk_size, np.float64)
+        self.columns = {name: np.zeros((chunk_size, n), dtype) for name, dtype in COLUMNS.items()}
+        self.n_ticks = 0  # in the current chunk
+        self.n_chunks = 0
+        self.ticks_recorded = 0
+
+    def record(self, time, drones):
+        row = self.n_ticks
+        self.time[row] = time
+        columns = self.columns
+        for i, key in enumerate(self.keys):
+            drone = drones[key]
+            columns["x"][row, i] = drone.x
+            columns["y"][row, i] = drone.y
+            columns["state"][row, i] = STATE_CODES[drone.state]
+            columns["lifetime_left"][row, i] = drone.lifetime_left
+            columns["target_x"][row, i] = np.nan if drone.targetX is None else drone.targetX
+            columns["target_y"][row, i] = np.nan if drone.targetY is None else drone.targetY
+            mission = drone.targetMission
+            if mission is None:
+                columns["mission"][row, i] = -1
+                columns["mission_progress"][row, i] = 0.0
+            else:
+                columns["mission"][row, i] = mission.key
+                columns["mission_progress"][row, i] = mission.n_waypoints_visited / max(1, len(mission.waypoints))
+        self.n_ticks += 1
+        self.ticks_recorded += 1
+        if self.n_ticks == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.n_ticks == 0:
+            return
+        n = self.n_ticks
+        np.savez(os.path.join(self.path, "chunk_{:05d}.npz".format(self.n_chunks)),
+                 time=self.time[:n], **{name: column[:n] for name, column in self.columns.items()})
+        self.n_chunks += 1
+        self.n_ticks = 0
+
+    def close(self):
+        self.flush()
+
+
+class ReplayDrone:
+
+    # minimal drone-like object, so that World.drawDrones can draw recorded drones
+    def __init__(self, key, is_master, max_lifetime=None):
+        self.key = key
+        self.is_master = is_master
+        self.max_lifetime = max_lifetime  # None in recordings made before it was saved
+        self.x, self.y = 0.0, 0.0
+        self.state = STATES[0]
+        self.targetX, self.targetY = None, None
+        self.lifetime_left = 0.0
+        self.mission = -1
+        self.mission_progress = 0.0
+
+    def distanceTo(self, x, y):
+        return dist(x - self.x, y - self.y)
+
+    def label(self):
+        # battery as percent of max lifetime (or seconds left) and target mission with its visited waypoints share
+        text = "{} {}".format(self.key + ("M" if self.is_master else ""), self.state)
+        if self.max_lifetime is not None:
+            text += " {:.0f}%".format(100.0 * self.lifetime_left / self.max_lifetime)
+        else:
+            text += " {:.0f}s".format(self.lifetime_left)
+        if self.mission >= 0:
+            text += " m{} {:.0f}%".format(self.mission, 100.0 * self.mission_progress)
+        return text
+
+
+class TelemetryReplay:
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            self.meta = json.load(file)
+        self.keys = self.meta["drones"]
+        self.states = self.meta["states"]
+        self.chunk_paths = sorted(glob.glob(os.path.join(path, "chunk_*.npz")))
+        assert len(self.chunk_paths) > 0, "no telemetry chunks in {}".format(path)
+        # only chunk lengths are read here, columns are loaded on demand
+        self.chunk_offsets = [0]
+        for chunk_path in self.chunk_paths:
+            with np.load(chunk_path) as chunk:
+                self.chunk_offsets.append(self.chunk_offsets[-1] + len(chunk["time"]))
+        self.loaded_chunk_index = None
+        self.loaded_chunk = None
+        max_lifetimes = self.meta.get("max_lifetimes", [None] * len(self.keys))
+        self.drones = {key: ReplayDrone(key, is_master, max_lifetime)
+                       for key, is_master, max_lifetime in zip(self.keys, self.meta["masters"], max_lifetimes)}
+
+    def __len__(self):
+        return self.chunk_offsets[-1]
+
+    def chunk(self, tick):
+        index = int(np.searchsorted(self.chunk_offsets, tick, side='right')) - 1
+        if index != self.loaded_chunk_index:
+            with np.load(self.chunk_paths[index]) as chunk:
+                self.loaded_chunk = {name: chunk[name] for name in chunk.files}
+            self.loaded_chunk_index = index
+        return self.loaded_chunk, tick - self.chunk_offsets[index]
+
+    def time(self, tick):
+        chunk, row = self.chunk(tick)
+        return float(chunk["time"][row])
+
+    def seek(self, tick):
+        # updates self.drones to the recorded state at tick
+        chunk, row = self.chunk(tick)
+        for i, key in enumerate(self.keys):
+            drone = self.drones[key]
+            drone.x, drone.y = float(chunk["x"][row, i]), float(chunk["y"][row, i])
+            drone.state = self.states[chunk["state"][row, i]]
+            drone.lifetime_left = float(chunk["lifetime_left"][row, i])
+            target_x, target_y = chunk["target_x"][row, i], chunk["target_y"][row, i]
+            drone.targetX, drone.targetY = (None, None) if np.isnan(target_x) else (float(target_x), float(target_y))
+            drone.mission = int(chunk["mission"][row, i])
+            drone.mission_progress = float(chunk["mission_progress"][row, i])
+        return self.drones
@@ -0,0 +1,165 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from geometry import segmentsIntersect
+from metrics import metrics
+
+
+# Spatial decomposition of the pair tests of a simulation tick (collision checks and wireless links).
+# The world is split into tiles_x*tiles_y tiles, each drone is assigned to the tile that contains its position.
+# Every tile job gets its own drones and a halo - drones of other tiles close enough to the tile border:
+#  - for collision checks halo width is the sum of the two longest moves of this tick
+#    (two move segments can intersect only if their start points are closer than that),
+#  - for wireless links halo width is wireless_range.
+# Each tile job tests only pairs of its drones with its candidates, instead of all pairs of the swarm.
+# Tiles are only a partition of pair tests: the assignment is recomputed from positions every tick ("handovers" counts
+# drones assigned to another tile than in the previous tick). Tile jobs run in the simulation process:
+# shipping them to worker processes every tick costs more than the pair tests themselves.
+#
+# Drone.update (moves, batteries, scheduling) runs in sorted keys order, so the result does not depend on the tiles. Collision decisions are taken on positions at the beginning of the tick,
+# which gives the same decisions as sequential Drone.fly: a drone only gives way to drones with larger keys,
+# and those have not moved yet in this tick.
+
+
+def processTile(owned, candidates, wireless_range, check_collisions):
+    # owned/candidates - arrays with rows (rank, x, y, next_x, next_y), rank is index in sorted drone keys,
+    # candidates include owned drones and the halo
+    # returns collisions [(rank, rank of drone with larger key), ...], links [(rank0, rank1), ...] and number of pair tests
+    collisions, links = [], []
+    if len(owned) == 0:
+        return collisions, links, 0
+    rank0, rank1 = owned[:, 0:1], candidates[None, :, 0]
+    x0, y0, nx0, ny0 = owned[:, 1:2], owned[:, 2:3], owned[:, 3:4], owned[:, 4:5]
+    x1, y1, nx1, ny1 = candidates[None, :, 1], candidates[None, :, 2], candidates[None, :, 3], candidates[None, :, 4]
+
+    if check_collisions:
+        intersects = segmentsIntersect(x0, y0, nx0, ny0, x1, y1, nx1, ny1) & (rank0 < rank1)
+        for i, j in zip(*np.nonzero(intersects)):
+            collisions.append((int(owned[i, 0]), int(candidates[j, 0])))
+    else:
+        # each link is reported once - by the tile that owns the drone with the smaller key
+        distances = np.sqrt((x1 - x0) ** 2 + (y1 - y0) ** 2)
+        connected = (distances > 0) & (distances <= wireless_range) & (rank0 < rank1)
+        for i, j in zip(*np.nonzero(connected)):
+            links.append((int(owned[i, 0]), int(candidates[j, 0])))
+    return collisions, links, owned.shape[0] * candidates.shape[0]
+
+
+class TileEngine:
+
+    def __init__(self, world, drones, tiles_x=4, tiles_y=4):
+        self.world = world
+        self.drones = drones
+        self.tiles_x, self.tiles_y = tiles_x, tiles_y
+        self.tile_width = world.dem_image.width * world.dem_resolution / tiles_x
+        self.tile_height = world.dem_image.height * world.dem_resolution / tiles_y
+
+        self.keys = None
+        self.owners = {}  # drone key -> tile index, which tile job tests its pairs
+        self.collisions = {}  # drone key -> keys of drones with larger keys it must give way to in this tick
+        self.components = None  # rank -> wireless network component, None if positions changed since the last estimation
+
+        self.ticks = 0
+        self.handovers = 0
+        self.halo_drones = 0
+        self.tile_jobs = 0
+        self.pair_tests = 0
+
+    def stats(self):
+        return {"tiles": self.tiles_x * self.tiles_y, "ticks": self.ticks, "handovers": self.handovers,
+                "halo_drones": self.halo_drones, "tile_jobs": self.tile_jobs, "pair_tests": self.pair_tests}
+
+    def snapshot(self, dt):
+        self.keys = sorted(self.drones.keys())
+        rows = np.zeros((len(self.keys), 5), np.float64)
+        for rank, key in enumerate(self.keys):
+            drone = self.drones[key]
+            next_x, next_y = drone.predictNextPosition(dt) if dt is not None else (drone.x, drone.y)
+            rows[rank] = (rank, drone.x, drone.y, next_x, next_y)
+        return rows
+
+    def tileOf(self, xs, ys):
+        i = np.clip((xs // self.tile_width).astype(np.int64), 0, self.tiles_x - 1)
+        j = np.clip((ys // self.tile_height).astype(np.int64), 0, self.tiles_y - 1)
+        return j * self.tiles_x + i
+
+    def updateOwners(self, rows):
+        tiles = self.tileOf(rows[:, 1], rows[:, 2])
+        for rank, key in enumerate(self.keys):
+            tile = int(tiles[rank])
+            if key in self.owners and self.owners[key] != tile:
+                self.handovers += 1
+            self.owners[key] = tile
+        return tiles
+
+    def runTiles(self, rows, halo_width, check_collisions):
+        tiles = self.updateOwners(rows)
+        xs, ys = rows[:, 1], rows[:, 2]
+        jobs = []
+        for tile in range(self.tiles_x * self.tiles_y):
+            owned = rows[tiles == tile]
+            if len(owned) == 0:
+                continue
+            x0, y0 = (tile % self.tiles_x) * self.tile_width, (tile // self.tiles_x) * self.tile_height
+            x1, y1 = x0 + self.tile_width, y0 + self.tile_height
+            dx = np.maximum(np.maximum(x0 - xs, xs - x1), 0)
+            dy = np.maximum(np.maximum(y0 - ys, ys - y1), 0)
+            in_halo = (dx * dx + dy * dy <= halo_width * halo_width) & (tiles != tile)
+            self.halo_drones += int(np.count_nonzero(in_halo))
+            jobs.append((owned, np.concatenate([owned, rows[in_halo]])))
+        self.tile_jobs += len(jobs)
+
+        collisions, links = [], []
+        for owned, candidates in jobs:
+            tile_collisions, tile_links, pair_tests = processTile(owned, candidates, self.world.wireless_range, check_collisions)
+            collisions += tile_collisions
+            links += tile_links
+            self.pair_tests += pair_tests
+            metrics.inc("collision_pair_tests" if check_collisions else "wireless_pair_tests", pair_tests)
+        return collisions, links
+
+    def planMoves(self, dt):
+        rows = self.snapshot(dt)
+        steps = np.sort(np.hypot(rows[:, 3] - rows[:, 1], rows[:, 4] - rows[:, 2]))
+        halo_width = float(steps[-2:].sum()) + 1e-6
+        collisions, _ = self.runTiles(rows, halo_width, True)
+        self.collisions = {}
+        for rank0, rank1 in sorted(collisions):
+            self.collisions.setdefault(self.keys[rank0], []).append(self.keys[rank1])
+
+    def collisionsOf(self, drone):
+        return self.collisions.get(drone.key, [])
+
+    def componentLabels(self):
+        # wireless network component of every drone, in sorted keys order
+        if self.components is None:
+            rows = self.snapshot(None)
+            _, links = self.runTiles(rows, self.world.wireless_range + 1e-6, False)
+            n = len(self.keys)
+            links = np.array(links, np.int64).reshape(-1, 2)
+            graph = coo_matrix((np.ones(len(links)), (links[:, 0], links[:, 1])), shape=(n, n))
+            _, self.components = connected_components(graph, directed=False)
+        return self.components
+
+    def reachableDrones(self, drone):
+        # the same result as World.findWirelessReachableDrones: drones connected through links not longer than wireless range
+        self.componentLabels()
+        component = self.components[self.keys.index(drone.key)]
+        reachable_drones = {}
+        for rank, key in enumerate(self.keys):
+            that = self.drones[key]
+            if self.components[rank] == component or (that.x, that.y) == (drone.x, drone.y):
+                reachable_drones[key] = that
+        return reachable_drones
+
+    def updateDrones(self, dt):
+        with metrics.phase("tile_collisions"):
+            self.planMoves(dt)
+        self.components = None
+        for key in sorted(self.drones.keys()):
+            self.drones[key].update(self.world, dt)
+        self.collisions = {}
+        self.components = None  # drones moved
+        self.ticks += 1
+
@@ -1,6 +1,8 @@
 import math
 import numpy as np
 
+from geometry import distancesPointToSegments
+
 
 def dist(x, y):
     return math.sqrt(x * x + y * y)
@@ -15,48 +17,31 @@ def isIntersects(ax, ay, bx, by, cx, cy, dx, dy):
 
     return ccw(ax, ay, cx, cy, dx, dy) != ccw(bx, by, cx, cy, dx, dy) and ccw(ax, ay, bx, by, cx, cy) != ccw(ax, ay, bx, by, dx, dy)
 
-def distancePointToSegment(px, py, ax, ay, bx, by):
-    p = np.float32([px, py])
-    a = np.float32([ax, ay])
-    b = np.float32([bx, by])
-
-    point = p
-    line = [a, b]
-    # see https://stackoverflow.com/a/45483585
-    unit_line = line[1] - line[0]
-    norm_unit_line = unit_line / np.linalg.norm(unit_line)
-
-    # compute the perpendicular distance to the theoretical infinite line
-    segment_dist = (
-            np.linalg.norm(np.cross(line[1] - line[0], line[0] - point)) /
-            np.linalg.norm(unit_line)
-    )
+def pointsInPolygon(xs, ys, polygon):
+    # vectorized even-odd (crossing number) test, points lying exactly on the polygon boundary are outside
+    # (the same as shapely's Polygon.contains)
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    inside = np.zeros(np.broadcast(xs, ys).shape, dtype=bool)
+    on_boundary = np.zeros_like(inside)
+    n = len(polygon)
+    for i in range(n):
+        x0, y0 = map(float, polygon[i])
+        x1, y1 = map(float, polygon[(i + 1) % n])
+        if (x0, y0) == (x1, y1):
+            continue
+        crosses = (y0 > ys) != (y1 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_intersection = x0 + (ys - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (xs < x_intersection)
 
-    diff = (
-            (norm_unit_line[0] * (point[0] - line[0][0])) +
-            (norm_unit_line[1] * (point[1] - line[0][1]))
-    )
+        cross = (x1 - x0) * (ys - y0) - (y1 - y0) * (xs - x0)
+        on_boundary |= (cross == 0) & (np.minimum(x0, x1) <= xs) & (xs <= np.maximum(x0, x1)) \
+                       & (np.minimum(y0, y1) <= ys) & (ys <= np.maximum(y0, y1))
+    return inside & ~on_boundary
 
-    x_seg = (norm_unit_line[0] * diff) + line[0][0]
-    y_seg = (norm_unit_line[1] * diff) + line[0][1]
-
-    endpoint_dist = min(
-        np.linalg.norm(line[0] - point),
-        np.linalg.norm(line[1] - point)
-    )
-
-    # decide if the intersection point falls on the line segment
-    lp1_x = line[0][0]  # line point 1 x
-    lp1_y = line[0][1]  # line point 1 y
-    lp2_x = line[1][0]  # line point 2 x
-    lp2_y = line[1][1]  # line point 2 y
-    is_betw_x = lp1_x <= x_seg <= lp2_x or lp2_x <= x_seg <= lp1_x
-    is_betw_y = lp1_y <= y_seg <= lp2_y or lp2_y <= y_seg <= lp1_y
-    if is_betw_x and is_betw_y:
-        return segment_dist
-    else:
-        # if not, then return the minimum distance to the segment endpoints
-        return endpoint_dist
+def distancePointToSegment(px, py, ax, ay, bx, by):
+    return float(distancesPointToSegments(px, py, ax, ay, bx, by))
 
 def simplifyPath(xys, max_error):
     progress = True
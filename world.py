@@ -1,16 +1,23 @@
+import concurrent.futures
+import heapq
 import json
+import threading
 import numpy as np
 from PIL import Image
 import colors
 import networkx as nx
-from utils import dist, simplifyPath
+from utils import dist, simplifyPath, pointsInPolygon
+from metrics import metrics
+from eventlog import events, RouteRepaired, RouteBlocked, NoFlyZonesUpdated
+from mission import MissionPath
+from dstar import DStarLite
 
 import cv2
 
 
 class World:
 
-    def __init__(self, json_path, window_height) -> None:
+    def __init__(self, json_path, window_height, prepair_path_planning=True) -> None:
         with open(json_path, "r") as file:
             world_data = json.load(file)
         assert "world" in world_data
@@ -35,7 +42,19 @@ class World:
         self.control_station = None
         self.charge_stations = None
 
-        self.prepairPathPlanning()
+        self.cachedPaths = {}
+        self.cachedPathVertices = {}
+        self.cachedPathsByVertex = {}
+        self.dem_base_prohibited_mask = self.dem_prohibited_mask
+        self.no_fly_zones = {}  # key -> (polygon, pixels mask), see addNoFlyZone
+        self.no_fly_counts = np.zeros(self.dem_prohibited_mask.shape, np.int32)  # number of zones covering each pixel
+        self.next_no_fly_zone_key = 1
+        self.dstar_planners = {}  # goal vertex -> DStarLite
+        self.tile_engine = None  # see tiles.TileEngine
+        self.anytime_planner = None  # see anytime.AnytimePlanner
+        self.paths_lock = threading.RLock()  # path planning and cached paths, ShardedScheduler plans from several threads
+        if prepair_path_planning:  # not needed f.e. for telemetry replay
+            self.prepairPathPlanning()
 
     def addDrones(self, drones):
         self.drones = drones
@@ -81,11 +100,11 @@ class World:
         master_color = colors.RED
         drone_color = colors.BLUE
 
-        for key, drone in self.drones.items():
+        for drone in self.drones.values():
             x, y = self.toWindowPixel(drone.x, drone.y)
             cv2.circle(frame, (x, y), drone_radius, master_color if drone.is_master else drone_color)
 
-            text = "{} {}".format(key + ("M" if drone.is_master else ""), drone.state)
+            text = drone.label()
             font = cv2.FONT_HERSHEY_SIMPLEX
             bottomLeftCornerOfText = (x + 10, y)
             fontColor = colors.BLACK
@@ -156,6 +175,11 @@ class World:
             x, y = self.toWindowPixel(station.x, station.y)
             cv2.circle(frame, (x, y), station_radius, charge_station_color, station_thickness)
 
+    def vertexDistance(self, u, v):
+        # straight line distance between pixels centers, a consistent lower bound of path cost
+        (i0, j0), (i1, j1) = self.fromVertexId(u), self.fromVertexId(v)
+        return dist((i1 - i0) * self.dem_resolution, (j1 - j0) * self.dem_resolution)
+
     def toVertexId(self, i, j):
         return j * self.dem_image.width + i
 
@@ -180,60 +204,247 @@ class World:
                     v1 = self.toVertexId(i+1, j+1)
                     self.g.add_edge(v0, v1, weight=1.41)
                 else:
-                    if self.dem_prohibited_mask[j, i]:
-                        continue
-                    # for dj in range(2):
-                    #     for di in range(-1, 2):
-                    for dj in range(3):
-                        for di in range(-2, 3):
-                            if di == 0 and dj == 0:
-                                continue
-                            if i + di < 0 or i + di >= self.dem_image.width or j + dj >= self.dem_image.height:
-                                continue
-                            if self.dem_prohibited_mask[j + dj, i + di]:
-                                continue
-                            if abs(di) == 2 and dj == 0 and self.dem_prohibited_mask[j + 0, i + di // 2]:
-                                continue
-                            if abs(di) == 2 and dj == 1 and self.dem_prohibited_mask[j + 0, i + di // 2] and \
-                                    self.dem_prohibited_mask[j + 1, i + di // 2]:
-                                continue
-                            if abs(di) == 1 and dj == 2 and self.dem_prohibited_mask[j + dj // 2, i + 0] and \
-                                    self.dem_prohibited_mask[j + dj // 2, i + di]:
-                                continue
-                            if abs(di) == 0 and dj == 2 and self.dem_prohibited_mask[j + 1, i + 0]:
-                                continue
-                            distance = dist(di * self.dem_resolution, dj * self.dem_resolution)
-                            v0 = self.toVertexId(i, j)
-                            v1 = self.toVertexId(i + di, j + dj)
-                            v0, v1 = min(v0, v1), max(v0, v1)
-                            self.g.add_edge(v0, v1, weight=distance)
+                    for v0, v1, distance in self.cellEdges(i, j, self.dem_prohibited_mask):
+                        self.g.add_edge(v0, v1, weight=distance)
         self.cachedPaths = {}
+        self.cachedPathVertices = {}  # cached path key -> vertices of not simplified path
+        self.cachedPathsByVertex = {}  # vertex -> keys of cached paths through it
         print("graph prepaired!")
 
-    def estimatePath(self, x0, y0, x1, y1):
-        start = (x0, y0)
-        finish = (x1, y1)
+    def cellEdges(self, i, j, mask):
+        # edges from pixel (i, j) to its neighbors that are allowed w.r.t. prohibited mask
+        if i >= self.dem_image.width - 1 or j >= self.dem_image.height - 1 or mask[j, i]:
+            return
+        # for dj in range(2):
+        #     for di in range(-1, 2):
+        for dj in range(3):
+            for di in range(-2, 3):
+                if di == 0 and dj == 0:
+                    continue
+                if i + di < 0 or i + di >= self.dem_image.width or j + dj >= self.dem_image.height:
+                    continue
+                if mask[j + dj, i + di]:
+                    continue
+                if abs(di) == 2 and dj == 0 and mask[j + 0, i + di // 2]:
+                    continue
+                if abs(di) == 2 and dj == 1 and mask[j + 0, i + di // 2] and \
+                        mask[j + 1, i + di // 2]:
+                    continue
+                if abs(di) == 1 and dj == 2 and mask[j + dj // 2, i + 0] and \
+                        mask[j + dj // 2, i + di]:
+                    continue
+                if abs(di) == 0 and dj == 2 and mask[j + 1, i + 0]:
+                    continue
+                distance = dist(di * self.dem_resolution, dj * self.dem_resolution)
+                v0 = self.toVertexId(i, j)
+                v1 = self.toVertexId(i + di, j + dj)
+                v0, v1 = min(v0, v1), max(v0, v1)
+                yield v0, v1, distance
+
+    def addNoFlyZone(self, polygon):
+        # temporary prohibited polygon (f.e. weather or emergency), returns key for removeNoFlyZone
+        cells = self.polygonCells(polygon)
+        key = self.next_no_fly_zone_key
+        self.next_no_fly_zone_key += 1
+        self.no_fly_zones[key] = (polygon, cells)
+        self.no_fly_counts[cells] += 1
+        self.updateProhibitedMask(cells)
+        return key
+
+    def removeNoFlyZone(self, key):
+        polygon, cells = self.no_fly_zones.pop(key)
+        self.no_fly_counts[cells] -= 1
+        self.updateProhibitedMask(cells)
+
+    def polygonCells(self, polygon):
+        # pixels with centers inside of polygon
+        xs = [x for x, y in polygon]
+        ys = [y for x, y in polygon]
+        i0, i1 = max(0, int(min(xs) // self.dem_resolution)), min(self.dem_image.width - 1, int(max(xs) // self.dem_resolution))
+        j0, j1 = max(0, int(min(ys) // self.dem_resolution)), min(self.dem_image.height - 1, int(max(ys) // self.dem_resolution))
+        cells = np.zeros(self.dem_prohibited_mask.shape, bool)
+        if i0 > i1 or j0 > j1:
+            return cells
+        js, is_ = np.mgrid[j0:j1 + 1, i0:i1 + 1]
+        cells[j0:j1 + 1, i0:i1 + 1] = pointsInPolygon((is_ + 0.5) * self.dem_resolution, (js + 0.5) * self.dem_resolution, polygon)
+        return cells
+
+    def updateProhibitedMask(self, cells):
+        old_mask = self.dem_prohibited_mask
+        self.dem_prohibited_mask = self.dem_base_prohibited_mask | (self.no_fly_counts > 0)
+        changed_js, changed_is = np.nonzero((old_mask != self.dem_prohibited_mask) & cells)
+        if len(changed_js) == 0:
+            return
+
+        # edges from pixel (i, j) depend on pixels (i-2..i+2, j..j+2), so only these origins are affected
+        origins = set()
+        for j, i in zip(changed_js, changed_is):
+            for dj in range(-2, 1):
+                for di in range(-2, 3):
+                    if 0 <= i + di < self.dem_image.width and 0 <= j + dj < self.dem_image.height:
+                        origins.add((int(i + di), int(j + dj)))
+        removed_edges, added_edges = set(), set()
+        for i, j in origins:
+            old_edges = set(self.cellEdges(i, j, old_mask))
+            new_edges = set(self.cellEdges(i, j, self.dem_prohibited_mask))
+            removed_edges |= old_edges - new_edges
+            added_edges |= new_edges - old_edges
+        for v0, v1, distance in removed_edges:
+            self.g.remove_edge(v0, v1)
+        for v0, v1, distance in added_edges:
+            self.g.add_edge(v0, v1, weight=distance)
+
+        # cached paths stay valid when edges are added (though maybe not the shortest ones), so only paths
+        # that use removed edges are dropped
+        removed = set((v0, v1) for v0, v1, distance in removed_edges)
+        invalidated = set()
+        for v0, v1 in removed:
+            for key in self.cachedPathsByVertex.get(v0, ()):
+                vertices = self.cachedPathVertices[key]
+                for a, b in zip(vertices[:-1], vertices[1:]):
+                    if (min(a, b), max(a, b)) in removed:
+                        invalidated.add(key)
+                        break
+        for key in invalidated:
+            self.forgetCachedPath(key)
+
+        changed_vertices = set(v for edge in removed | set((v0, v1) for v0, v1, distance in added_edges) for v in edge)
+        for planner in self.dstar_planners.values():
+            planner.edgesChanged(changed_vertices)
+        if self.anytime_planner is not None:
+            self.anytime_planner.prohibitedMaskChanged()
+        metrics.inc("no_fly_removed_edges", len(removed_edges))
+        metrics.inc("no_fly_added_edges", len(added_edges))
+        metrics.inc("no_fly_invalidated_paths", len(invalidated))
+        events.emit(NoFlyZonesUpdated, len(removed_edges), len(added_edges), len(invalidated))
+
+        if len(removed_edges) > 0 and self.drones is not None:
+            self.repairRoutes()
+
+    def forgetCachedPath(self, key):
+        self.cachedPaths.pop(key, None)
+        for vertex in self.cachedPathVertices.pop(key, ()):
+            keys = self.cachedPathsByVertex.get(vertex)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.cachedPathsByVertex[vertex]
+
+    def isRouteBlocked(self, xys):
+        # checks segments of the route with quarter of pixel step against prohibited mask
+        for (x0, y0), (x1, y1) in zip(xys[:-1], xys[1:]):
+            n = max(1, int(dist(x1 - x0, y1 - y0) / (self.dem_resolution / 4.0)))
+            ts = np.linspace(0.0, 1.0, n + 1)
+            i = np.clip(((x0 + (x1 - x0) * ts) // self.dem_resolution).astype(np.int64), 0, self.dem_image.width - 1)
+            j = np.clip(((y0 + (y1 - y0) * ts) // self.dem_resolution).astype(np.int64), 0, self.dem_image.height - 1)
+            if self.dem_prohibited_mask[j, i].any():
+                return True
+        return False
+
+    def dstarPlanner(self, goalId):
+        # one incremental planner per goal vertex, created lazily and reused by all drones flying there
+        planner = self.dstar_planners.get(goalId)
+        if planner is None:
+            planner = DStarLite(self.g.adj, goalId, self.vertexDistance)
+            self.dstar_planners[goalId] = planner
+        return planner
+
+    def repairRoutes(self):
+        # in-flight drones which remaining route crosses prohibited pixels get a new route from D* Lite
+        for key in sorted(self.drones.keys()):
+            drone = self.drones[key]
+            route = drone.pathPlannerMission
+            if route is None or route.finished():
+                continue
+            remaining = [(drone.x, drone.y)] + list(route.waypoints[route.n_waypoints_visited:])
+            if not self.isRouteBlocked(remaining):
+                continue
+            finish = route.getLastWaypoint()
+            startId, finishId = self.navigableVertexId(drone.x, drone.y), self.navigableVertexId(*finish)
+            with metrics.phase("path_repair"):
+                vertices = self.dstarPlanner(finishId).plan(startId)
+            if vertices is None:
+                events.emit(RouteBlocked, key)
+                continue
+            drone.pathPlannerMission = MissionPath(0, "", self.pathFromVertices((drone.x, drone.y), finish, vertices))
+            drone.targetX, drone.targetY = drone.pathPlannerMission.nextWaypoint()
+            events.emit(RouteRepaired, key, len(vertices))
 
+    def positionToVertexId(self, x, y):
         # to DEM image pixels coordinates:
-        x0, y0 = x0 // self.dem_resolution, y0 // self.dem_resolution
-        x1, y1 = x1 // self.dem_resolution, y1 // self.dem_resolution
-        assert x0 >= 0 and x0 < self.dem_image.width and x1 >= 0 and x1 < self.dem_image.width
-        assert y0 >= 0 and y0 < self.dem_image.height and y1 >= 0 and y1 < self.dem_image.height
+        i, j = x // self.dem_resolution, y // self.dem_resolution
+        assert i >= 0 and i < self.dem_image.width
+        assert j >= 0 and j < self.dem_image.height
+        return self.toVertexId(i, j)
+
+    def navigableVertexId(self, x, y):
+        # vertex of the pixel or, if the pixel is prohibited (f.e. drone is inside of just added no-fly zone),
+        # of the nearest pixel with allowed edges, so that the drone can leave prohibited area
+        vertexId = self.positionToVertexId(x, y)
+        if vertexId in self.g and self.g.degree(vertexId) > 0:
+            return vertexId
+        i0, j0 = map(int, self.fromVertexId(vertexId))
+        for radius in range(1, max(self.dem_image.width, self.dem_image.height)):
+            best, best_distance = None, None
+            for j in range(j0 - radius, j0 + radius + 1):
+                for i in range(i0 - radius, i0 + radius + 1):
+                    if max(abs(i - i0), abs(j - j0)) != radius:
+                        continue
+                    if i < 0 or i >= self.dem_image.width or j < 0 or j >= self.dem_image.height:
+                        continue
+                    candidate = self.toVertexId(i, j)
+                    distance = dist(i - i0, j - j0)
+                    if candidate in self.g and self.g.degree(candidate) > 0 and (best is None or distance < best_distance):
+                        best, best_distance = candidate, distance
+            if best is not None:
+                return best
+        return vertexId
+
+    def cachedPath(self, key, start, finish):
+        xys = self.cachedPaths[key].copy()
+        xys[0] = start
+        xys[-1] = finish
+        return xys
 
-        startId = self.toVertexId(x0, y0)
-        finishId = self.toVertexId(x1, y1)
+    def estimatePath(self, x0, y0, x1, y1):
+        start = (x0, y0)
+        finish = (x1, y1)
+        startId = self.navigableVertexId(x0, y0)
+        finishId = self.navigableVertexId(x1, y1)
 
         key = (startId, finishId)
-        if key in self.cachedPaths:
-            xys = self.cachedPaths[key].copy()
-            xys[0] = start
-            xys[-1] = finish
-            return xys
-
-        vertices = nx.shortest_path(self.g, source=startId, target=finishId, weight='weight')
+        with self.paths_lock:
+            if key in self.cachedPaths:
+                metrics.inc("path_cache_hits")
+                return self.cachedPath(key, start, finish)
+            metrics.inc("path_cache_misses")
+
+            with metrics.phase("path_planning"):
+                return self.planPath(start, finish, startId, finishId)
+
+    def planPath(self, start, finish, startId, finishId):
+        if metrics.enabled:
+            relaxations = [0]
+
+            def weight(u, v, data):
+                relaxations[0] += 1
+                return data['weight']
+            vertices = nx.shortest_path(self.g, source=startId, target=finishId, weight=weight)
+            metrics.inc("dijkstra_edge_relaxations", relaxations[0])
+        else:
+            vertices = nx.shortest_path(self.g, source=startId, target=finishId, weight='weight')
         assert vertices[0] == startId
         assert vertices[-1] == finishId
-
+        return self.pathFromVertices(start, finish, vertices)
+
+    def pathFromVertices(self, start, finish, vertices, cache=True):
+        startId, finishId = vertices[0], vertices[-1]
+        if startId == finishId:
+            # start and finish are in the same pixel, but may be different points
+            xys = [start, finish]
+            if cache:
+                self.cachePath((startId, finishId), xys, vertices)
+            return xys
         xys = []
         for curId in vertices:
             i, j = self.fromVertexId(curId)
@@ -250,10 +461,90 @@ class World:
         xys = simplifyPath(xys, max_error)
         assert xys[0] == start
         assert xys[-1] == finish
-        self.cachedPaths[key] = xys
+        if cache:
+            self.cachePath((startId, finishId), xys, vertices)
         return xys
 
+    def cachePath(self, key, xys, vertices):
+        # vertices are kept to invalidate only paths affected by no-fly zones
+        self.forgetCachedPath(key)
+        self.cachedPaths[key] = xys
+        self.cachedPathVertices[key] = vertices
+        for vertex in vertices:
+            self.cachedPathsByVertex.setdefault(vertex, set()).add(key)
+
+    def estimatePaths(self, pairs, executor=None, skip_unreachable=False):
+        # pairs - [(x0, y0, x1, y1), ...], returns paths in the same order (None for unreachable if skip_unreachable)
+        # not cached queries are grouped by start vertex, one Dijkstra per group is stopped when all its targets are settled
+        # executor - f.e. pool from pathPlanningPool(), to run groups in parallel
+        keys = []
+        groups = {}
+        for x0, y0, x1, y1 in pairs:
+            key = (self.navigableVertexId(x0, y0), self.navigableVertexId(x1, y1))
+            keys.append(key)
+            if key not in self.cachedPaths:
+                groups.setdefault(key[0], set()).add(key[1])
+        metrics.inc("path_cache_hits", len(keys) - sum(len(targets) for targets in groups.values()))
+        metrics.inc("path_cache_misses", sum(len(targets) for targets in groups.values()))
+
+        with metrics.phase("path_planning"):
+            sources = sorted(groups.keys())
+            targets = [sorted(groups[source]) for source in sources]
+            if executor is None:
+                results = map(dijkstraToTargets, [self.g.adj] * len(sources), sources, targets)
+            else:
+                results = executor.map(dijkstraToTargetsInWorker, sources, targets)
+            vertices = {}
+            for source, (paths, relaxations) in zip(sources, results):
+                metrics.inc("dijkstra_edge_relaxations", relaxations)
+                for target, path in paths.items():
+                    vertices[(source, target)] = path
+
+            xyss = []
+            for (x0, y0, x1, y1), key in zip(pairs, keys):
+                if key in self.cachedPaths:
+                    xyss.append(self.cachedPath(key, (x0, y0), (x1, y1)))
+                elif key in vertices:
+                    xyss.append(self.pathFromVertices((x0, y0), (x1, y1), vertices[key]))
+                elif skip_unreachable:
+                    xyss.append(None)
+                else:
+                    raise nx.NetworkXNoPath("Target {} cannot be reached from given source {}".format(key[1], key[0]))
+        return xyss
+
+    def pathPlanningPool(self, workers):
+        # worker processes get the navigation graph once, at start
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=setWorkerGraph, initargs=(self.g,))
+
+    def warmUpPaths(self, stations_xys, waypoints_xys, workers=0):
+        # precomputes paths from every station to every station and waypoint (f.e. first and last waypoints of missions)
+        # and back - the graph is undirected, so reversed path is a shortest path too
+        pairs = []
+        for x0, y0 in stations_xys:
+            for x1, y1 in list(stations_xys) + list(waypoints_xys):
+                if (x0, y0) != (x1, y1):
+                    pairs.append((x0, y0, x1, y1))
+        executor = self.pathPlanningPool(workers) if workers > 0 else None
+        try:
+            xyss = self.estimatePaths(pairs, executor, skip_unreachable=True)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        n_paths = 0
+        for (x0, y0, x1, y1), xys in zip(pairs, xyss):
+            if xys is None:
+                continue
+            n_paths += 1
+            key = (self.navigableVertexId(x1, y1), self.navigableVertexId(x0, y0))
+            if key not in self.cachedPaths:
+                self.cachePath(key, xys[::-1], self.cachedPathVertices[key[::-1]][::-1])
+        return n_paths
+
     def generateWirelessNetworkSpanningTree(self):
+        with metrics.phase("network_mst"):
+            return self.buildWirelessNetworkSpanningTree()
+
+    def buildWirelessNetworkSpanningTree(self):
         from scipy.sparse import csr_matrix
         from scipy.sparse.csgraph import minimum_spanning_tree
 
@@ -291,6 +582,36 @@ class World:
                          colors.GREEN if distance <= self.wireless_range else colors.RED)
 
     def getWirelessReachableDrones(self, drone):
+        with metrics.phase("reachability"):
+            if self.tile_engine is not None:
+                return self.tile_engine.reachableDrones(drone)
+            return self.findWirelessReachableDrones(drone)
+
+    def getWirelessComponents(self):
+        # [{key: drone}, ...] - all wireless network components at once, in the order of their smallest keys
+        with metrics.phase("reachability"):
+            keys = sorted(self.drones.keys())
+            if self.tile_engine is not None:
+                labels = self.tile_engine.componentLabels()
+            else:
+                labels = self.findWirelessComponentLabels(keys)
+            components = {}
+            for key, label in zip(keys, labels):
+                components.setdefault(int(label), {})[key] = self.drones[key]
+            return list(components.values())
+
+    def findWirelessComponentLabels(self, keys):
+        # drones are linked if they are not farther than wireless range, the same components as of the spanning tree
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        xs = np.array([self.drones[key].x for key in keys], np.float64)
+        ys = np.array([self.drones[key].y for key in keys], np.float64)
+        linked = np.hypot(xs[:, None] - xs[None, :], ys[:, None] - ys[None, :]) <= self.wireless_range
+        _, labels = connected_components(csr_matrix(linked), directed=False)
+        return labels
+
+    def findWirelessReachableDrones(self, drone):
         spanning_tree_matrix = self.generateWirelessNetworkSpanningTree()
         keys = sorted(self.drones.keys())
         for iStart, keyStart in enumerate(keys):
@@ -320,3 +641,45 @@ class World:
                     reachable_drones[key] = self.drones[key]
             assert drone in reachable_drones.values()
             return reachable_drones
+
+
+def dijkstraToTargets(adj, source, targets):
+    # single-source Dijkstra over networkx adjacency, stopped as soon as all targets are settled
+    # returns {target: [source, ..., target]} for reachable targets and number of edge relaxations
+    targets = set(targets)
+    if source not in adj:
+        return {}, 0
+    distances = {source: 0.0}
+    predecessors = {source: None}
+    heap = [(0.0, source)]
+    relaxations = 0
+    paths = {}
+    while heap and len(paths) < len(targets):
+        distance, u = heapq.heappop(heap)
+        if distance > distances[u]:
+            continue  # outdated heap entry
+        if u in targets:
+            path = [u]
+            while predecessors[path[-1]] is not None:
+                path.append(predecessors[path[-1]])
+            paths[u] = path[::-1]
+        for v, data in adj[u].items():
+            relaxations += 1
+            new_distance = distance + data['weight']
+            if new_distance < distances.get(v, float("inf")):
+                distances[v] = new_distance
+                predecessors[v] = u
+                heapq.heappush(heap, (new_distance, v))
+    return paths, relaxations
+
+
+worker_graph = None
+
+
+def setWorkerGraph(graph):
+    global worker_graph
+    worker_graph = graph
+
+
+def dijkstraToTargetsInWorker(source, targets):
+    return dijkstraToTargets(worker_graph.adj, source, targets)